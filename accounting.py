@@ -0,0 +1,136 @@
+"""
+Módulo de contabilidad de tráfico del portal cautivo.
+Convierte los contadores del firewall en actividad de las sesiones.
+"""
+
+import logging
+import time
+from array import array
+from threading import Thread, Event
+
+
+class TrafficCollector:
+    """
+    Recolector periódico de contadores de tráfico por IP.
+    
+    En cada ciclo hace una única lectura en bloque de los contadores del
+    firewall (FirewallManager.read_counters) y marca como activas las
+    sesiones cuyas IPs movieron paquetes desde el ciclo anterior. Así un
+    usuario que navega sin volver a tocar el portal no expira por inactividad,
+    y el coste por ciclo es un solo proceso sea cual sea el número de IPs.
+    
+    Los contadores se guardan en arrays ('Q', 64 bits sin signo) indexados
+    por un slot fijo por IP, de modo que los deltas de miles de IPs se
+    calculan recorriendo arrays compactos en paralelo. Los bytes se suman a
+    la cuota diaria de cada usuario y las sesiones que la superan se revocan.
+    """
+    
+    def __init__(self, firewall_manager, session_manager, interval=30):
+        """
+        Inicializa el recolector.
+        
+        Args:
+            firewall_manager: FirewallManager con cadena de contabilidad
+            session_manager: SessionManager al que se notifica la actividad
+            interval: Segundos entre lecturas de contadores
+        """
+        self.firewall_manager = firewall_manager
+        self.session_manager = session_manager
+        self.interval = interval
+        self.slots = {}  # {ip: índice en los arrays}
+        self.slot_ips = []  # índice -> ip
+        self.last_packets = array('Q')
+        self.last_bytes = array('Q')
+        self.stop_event = Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+    
+    def start(self):
+        """Inicia el hilo recolector."""
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Detiene el hilo recolector."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+    
+    def _run(self):
+        """Bucle del hilo: una recolección por intervalo."""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                self.logger.error(f"Error recolectando contadores de tráfico: {e}")
+    
+    def collect(self):
+        """
+        Hace una lectura de contadores, registra actividad y consumo, y revoca
+        las sesiones que superan la cuota.
+        
+        Returns:
+            Número de sesiones con actividad registrada
+        """
+        timestamp = time.time()
+        counters = self.firewall_manager.read_counters()
+        
+        # Reservar slot a las IPs nuevas; compactar si sobran muchos libres
+        if len(self.slot_ips) > 2 * len(counters) + 1024:
+            self._compact_slots(counters)
+        for ip in counters:
+            if ip not in self.slots:
+                self.slots[ip] = len(self.slot_ips)
+                self.slot_ips.append(ip)
+                self.last_packets.append(0)
+                self.last_bytes.append(0)
+        
+        # Lectura actual en arrays alineados con los anteriores; las IPs sin
+        # regla (ya bloqueadas) quedan a 0
+        size = len(self.slot_ips)
+        packets_now = array('Q', bytes(8 * size))
+        bytes_now = array('Q', bytes(8 * size))
+        slots = self.slots
+        for ip, (packets, bytes_) in counters.items():
+            index = slots[ip]
+            packets_now[index] = packets
+            bytes_now[index] = bytes_
+        
+        # Deltas: si el contador bajó, la regla se recreó y cuenta desde 0
+        byte_deltas = [now - last if now >= last else now
+                       for now, last in zip(bytes_now, self.last_bytes)]
+        slot_ips = self.slot_ips
+        active_ips = [slot_ips[i] for i, (now, last) in enumerate(zip(packets_now, self.last_packets))
+                      if now and now != last]
+        usage = {slot_ips[i]: delta for i, delta in enumerate(byte_deltas) if delta}
+        
+        self.last_packets = packets_now
+        self.last_bytes = bytes_now
+        
+        updated = 0
+        if active_ips:
+            updated = self.session_manager.record_activity(active_ips, timestamp)
+            self.logger.debug(f"Actividad de red en {updated} sesiones")
+        
+        if usage:
+            for ip in self.session_manager.record_usage(usage):
+                self._revoke(ip)
+        
+        return updated
+    
+    def _compact_slots(self, counters):
+        """Reasigna los slots dejando solo las IPs presentes en la lectura actual."""
+        last = {ip: (self.last_packets[i], self.last_bytes[i])
+                for ip, i in self.slots.items() if ip in counters}
+        self.slot_ips = list(last)
+        self.slots = {ip: i for i, ip in enumerate(self.slot_ips)}
+        self.last_packets = array('Q', (last[ip][0] for ip in self.slot_ips))
+        self.last_bytes = array('Q', (last[ip][1] for ip in self.slot_ips))
+    
+    def _revoke(self, ip_address):
+        """Cierra la sesión de una IP que superó la cuota y bloquea su tráfico."""
+        username = self.session_manager.get_username_by_ip(ip_address)
+        if self.session_manager.end_session(ip_address):
+            self.firewall_manager.block_ip(ip_address)
+            self.logger.info(f"Cuota diaria superada por '{username}': acceso revocado para {ip_address}")
@@ -0,0 +1,111 @@
+"""
+Módulo de caché de la tabla ARP del portal cautivo.
+Asocia IPs de clientes con su dirección MAC sin lanzar procesos por petición.
+"""
+
+import logging
+import time
+from threading import Thread, Event, Lock
+
+
+class ArpCache:
+    """
+    Copia en memoria de /proc/net/arp refrescada en bloque.
+    
+    Un hilo relee el archivo completo cada refresh_interval segundos y
+    publica un diccionario nuevo {ip: mac}; lookup() es una lectura de
+    diccionario sin locks. Si una IP no aparece (cliente recién llegado) se
+    fuerza una relectura, limitada a una cada min_refresh_interval segundos.
+    """
+    
+    INCOMPLETE_MAC = '00:00:00:00:00:00'
+    
+    def __init__(self, path='/proc/net/arp', refresh_interval=5.0, min_refresh_interval=0.5):
+        """
+        Inicializa la caché.
+        
+        Args:
+            path: Archivo con la tabla ARP del kernel
+            refresh_interval: Segundos entre relecturas periódicas
+            min_refresh_interval: Segundos mínimos entre relecturas forzadas por fallo
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.table = {}  # {ip: mac}, se reemplaza entero en cada relectura
+        self.last_refresh = 0.0
+        self.refresh_lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+    
+    def start(self):
+        """Carga la tabla e inicia el hilo de refresco."""
+        self.refresh()
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Detiene el hilo de refresco."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+    
+    def _run(self):
+        """Bucle del hilo: una relectura por intervalo."""
+        while not self.stop_event.wait(self.refresh_interval):
+            self.refresh()
+    
+    def refresh(self, blocking=True):
+        """
+        Relee la tabla ARP completa y publica la nueva copia.
+        
+        Args:
+            blocking: Con False, si otro hilo ya está releyendo no se espera
+        """
+        if not self.refresh_lock.acquire(blocking):
+            return
+        try:
+            with open(self.path) as f:
+                self.table = self._parse(f.read())
+        except OSError as e:
+            self.logger.error(f"Error leyendo la tabla ARP: {e}")
+        finally:
+            self.last_refresh = time.monotonic()
+            self.refresh_lock.release()
+    
+    @classmethod
+    def _parse(cls, content):
+        """
+        Parsea el contenido de /proc/net/arp.
+        
+        Formato: IP address, HW type, Flags, HW address, Mask, Device.
+        Se ignoran las entradas incompletas (flags 0x0 o MAC a ceros).
+        """
+        table = {}
+        for line in content.splitlines()[1:]:
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            ip, flags, mac = parts[0], parts[2], parts[3].lower()
+            if flags == '0x0' or mac == cls.INCOMPLETE_MAC:
+                continue
+            table[ip] = mac
+        return table
+    
+    def lookup(self, ip_address):
+        """
+        Obtiene la MAC de una IP.
+        
+        Args:
+            ip_address: Dirección IP del cliente
+            
+        Returns:
+            MAC en minúsculas, o None si no está en la tabla
+        """
+        mac = self.table.get(ip_address)
+        if mac is None and time.monotonic() - self.last_refresh >= self.min_refresh_interval:
+            self.refresh(blocking=False)
+            mac = self.table.get(ip_address)
+        return mac
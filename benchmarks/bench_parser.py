@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del parser HTTP del portal.
+
+Compara el HTTPRequest actual (bytes, headers perezosos) con la versión
+anterior basada en str, sobre una sonda de detección y un POST de login.
+
+Uso: python3 benchmarks/bench_parser.py [--iterations N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from server import HTTPRequest  # noqa: E402
+
+
+class LegacyHTTPRequest:
+    """Parser anterior: decodifica toda la petición y separa por líneas."""
+    
+    def __init__(self, raw_request):
+        lines = raw_request.split('\r\n')
+        
+        request_line = lines[0].split(' ')
+        self.method = request_line[0]
+        self.path = request_line[1]
+        self.version = request_line[2] if len(request_line) > 2 else 'HTTP/1.1'
+        
+        self.headers = {}
+        i = 1
+        while i < len(lines) and lines[i]:
+            if ':' in lines[i]:
+                key, value = lines[i].split(':', 1)
+                self.headers[key.strip().lower()] = value.strip()
+            i += 1
+        
+        self.body = '\r\n'.join(lines[i+1:]) if i < len(lines) else ''
+
+
+PROBE_HEAD = (
+    b"GET /generate_204 HTTP/1.1\r\n"
+    b"Host: connectivitycheck.gstatic.com\r\n"
+    b"User-Agent: Dalvik/2.1.0 (Linux; U; Android 13; Pixel 7 Build/TQ3A)\r\n"
+    b"Connection: Keep-Alive\r\n"
+    b"Accept-Encoding: gzip\r\n"
+    b"\r\n"
+)
+
+LOGIN_HEAD = (
+    b"POST /login HTTP/1.1\r\n"
+    b"Host: 192.168.137.1\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Content-Type: application/x-www-form-urlencoded\r\n"
+    b"Content-Length: 35\r\n"
+    b"Origin: http://192.168.137.1\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Referer: http://192.168.137.1/\r\n"
+    b"Upgrade-Insecure-Requests: 1\r\n"
+    b"\r\n"
+)
+LOGIN_BODY = b"username=usuario1&password=pass1234"
+
+
+def legacy_parse(head, body, touch_headers):
+    request = LegacyHTTPRequest((head + body).decode('utf-8', errors='ignore'))
+    if touch_headers:
+        request.headers.get('connection')
+        request.body
+    return request
+
+
+def bytes_parse(head, body, touch_headers):
+    request = HTTPRequest(head, body)
+    if touch_headers:
+        # Es la consulta que hace el handler: no construye el diccionario
+        request.get_header('connection')
+        request.body
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del parser HTTP')
+    parser.add_argument('--iterations', type=int, default=200000)
+    args = parser.parse_args()
+    
+    cases = [
+        ('sonda (solo línea de petición)', PROBE_HEAD, b'', False),
+        ('sonda (Connection consultado)', PROBE_HEAD, b'', True),
+        ('login POST (Connection + body)', LOGIN_HEAD, LOGIN_BODY, True),
+    ]
+    
+    print(f"{'caso':<34} {'legacy µs':>10} {'bytes µs':>10} {'mejora':>8}")
+    for name, head, body, touch in cases:
+        legacy = min(timeit.repeat(lambda: legacy_parse(head, body, touch),
+                                   number=args.iterations, repeat=3))
+        current = min(timeit.repeat(lambda: bytes_parse(head, body, touch),
+                                    number=args.iterations, repeat=3))
+        legacy_us = legacy / args.iterations * 1e6
+        current_us = current / args.iterations * 1e6
+        print(f"{name:<34} {legacy_us:>10.2f} {current_us:>10.2f} {legacy_us / current_us:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
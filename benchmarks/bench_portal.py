@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Generador de carga y benchmark del servidor HTTP del portal cautivo.
+
+Levanta CaptivePortalServer (o AsyncCaptivePortalServer) en loopback con
+gestores de usuarios, sesiones y firewall falsos (no tocan iptables ni
+users.json) y lo bombardea desde varios procesos cliente con una mezcla
+configurable de sondas GET, logins POST y registros POST.
+
+Informa de peticiones por segundo, latencias p50/p90/p99/máx por tipo y
+los picos de hilos y memoria del proceso servidor.
+
+Uso:
+    python3 benchmarks/bench_portal.py --engine threaded --workers 32 \\
+        --clients 200 --duration 10 --mix probe=80,login=15,register=5
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from server import CaptivePortalServer, AsyncCaptivePortalServer  # noqa: E402
+from sessions import SessionManager  # noqa: E402
+
+
+class StubUserManager:
+    """UserManager en memoria: acepta cualquier usuario con password 'bench'."""
+
+    def __init__(self):
+        self.users = set()
+        self.lock = Lock()
+
+    def authenticate(self, username, password):
+        return password == 'bench'
+
+    def register(self, username, email, password):
+        with self.lock:
+            if username in self.users:
+                return False
+            self.users.add(username)
+            return True
+
+    def list_users(self):
+        with self.lock:
+            return list(self.users)
+
+
+class StubSessionManager:
+    """SessionManager mínimo: un diccionario IP -> usuario sin expiración."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = Lock()
+
+    def create_session(self, ip_address, username, mac=None):
+        with self.lock:
+            self.sessions[ip_address] = username
+            return True
+
+    def is_authenticated(self, ip_address, mac=None):
+        return ip_address in self.sessions
+
+    def get_username_by_ip(self, ip_address):
+        return self.sessions.get(ip_address)
+
+    def end_session(self, ip_address):
+        with self.lock:
+            return self.sessions.pop(ip_address, None) is not None
+
+    def is_user_already_logged_in(self, username, exclude_ip=None):
+        return False, None
+
+    def start_session(self, ip_address, username, mac=None):
+        self.create_session(ip_address, username)
+        return True, [], []
+
+    def is_over_quota(self, username):
+        return False
+
+
+class StubFirewallManager:
+    """FirewallManager que simula el coste de un fork con una espera."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def _done(self):
+        """Future ya resuelto, como los que devuelve FirewallManager."""
+        if self.delay:
+            time.sleep(self.delay)
+        future = Future()
+        future.set_result(True)
+        return future
+
+    def allow_ip(self, ip_address, *args, **kwargs):
+        return self._done()
+
+    def block_ip(self, ip_address, *args, **kwargs):
+        return self._done()
+
+
+PROBE_PATHS = ['/generate_204', '/hotspot-detect.html', '/connecttest.txt', '/success.txt', '/']
+
+
+def build_request(kind, rnd, keep_alive):
+    """Construye los bytes de una petición del tipo indicado."""
+    connection = b'keep-alive' if keep_alive else b'close'
+    if kind == 'probe':
+        path = rnd.choice(PROBE_PATHS).encode()
+        return (b'GET ' + path + b' HTTP/1.1\r\nHost: portal\r\n'
+                b'Accept-Encoding: gzip\r\nConnection: ' + connection + b'\r\n\r\n')
+
+    if kind == 'login':
+        path = b'/login'
+        body = b'username=bench%d&password=bench' % rnd.randrange(1000)
+    else:
+        path = b'/register'
+        body = b'username=u%d&email=u@example.com&password=bench' % rnd.getrandbits(48)
+    return (b'POST ' + path + b' HTTP/1.1\r\nHost: portal\r\n'
+            b'Content-Type: application/x-www-form-urlencoded\r\n'
+            b'Content-Length: %d\r\nConnection: ' % len(body) + connection + b'\r\n\r\n' + body)
+
+
+def read_response(sock, buffer):
+    """
+    Lee una respuesta completa (headers + Content-Length).
+
+    Returns:
+        Tupla (código de estado, el servidor pide cerrar, bytes sobrantes),
+        o (None, True, b'') si el servidor cerró la conexión
+    """
+    while b'\r\n\r\n' not in buffer:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None, True, b''
+        buffer += chunk
+
+    head_end = buffer.index(b'\r\n\r\n') + 4
+    head = buffer[:head_end]
+    length = 0
+    close = False
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+
+    while len(buffer) < head_end + length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None, True, b''
+        buffer += chunk
+
+    status = int(head.split(b' ', 2)[1])
+    return status, close, buffer[head_end + length:]
+
+
+def client_loop(port, mix, deadline, keep_alive, seed, results):
+    """Hilo cliente: envía peticiones hasta el deadline y anota latencias."""
+    rnd = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    sock = None
+    buffer = b''
+
+    while time.monotonic() < deadline:
+        kind = rnd.choices(kinds, weights)[0]
+        request = build_request(kind, rnd, keep_alive)
+        start = time.perf_counter()
+        status = None
+        # Como los navegadores, si una conexión reutilizada resulta estar
+        # cerrada por el servidor se reintenta una vez con una nueva
+        for attempt in range(2):
+            reused = sock is not None
+            try:
+                if sock is None:
+                    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+                    buffer = b''
+                sock.sendall(request)
+                status, close, buffer = read_response(sock, buffer)
+            except OSError:
+                status, close = None, True
+
+            if status is None and sock is not None:
+                sock.close()
+                sock = None
+            if status is not None or not reused:
+                break
+
+        results.append((kind, status, time.perf_counter() - start))
+        if sock is not None and (close or not keep_alive):
+            sock.close()
+            sock = None
+
+    if sock is not None:
+        sock.close()
+
+
+def client_process(port, mix, duration, clients, keep_alive, seed, queue):
+    """Proceso cliente: lanza varios hilos y devuelve sus resultados."""
+    deadline = time.monotonic() + duration
+    results = []
+    threads = [
+        threading.Thread(target=client_loop,
+                         args=(port, mix, deadline, keep_alive, seed * 1000 + i, results))
+        for i in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(results)
+
+
+def rss_kb():
+    """Memoria residente actual del proceso en KB (Linux)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por el método del rango más cercano."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def parse_mix(text):
+    """Convierte 'probe=80,login=15,register=5' en un diccionario de pesos."""
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in ('probe', 'login', 'register'):
+            raise argparse.ArgumentTypeError(f"tipo de petición desconocido: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def report(results, elapsed, peak_threads, peak_rss, base_rss):
+    """Imprime el resumen del benchmark."""
+    print(f"\nDuración: {elapsed:.1f} s, peticiones: {len(results)}, "
+          f"req/s: {len(results) / elapsed:.0f}")
+    print(f"Pico de hilos del servidor (muestreo cada 50 ms): {peak_threads}, "
+          f"pico RSS: {peak_rss / 1024:.1f} MB (+{(peak_rss - base_rss) / 1024:.1f} MB)")
+
+    print(f"\n{'tipo':<10} {'total':>8} {'errores':>8} {'503':>6} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'máx ms':>8}")
+    kinds = sorted({kind for kind, _, _ in results}) + ['total']
+    for kind in kinds:
+        selected = [r for r in results if kind == 'total' or r[0] == kind]
+        errors = sum(1 for _, status, _ in selected if status is None or status >= 500 and status != 503)
+        overloaded = sum(1 for _, status, _ in selected if status == 503)
+        latencies = sorted(latency * 1000 for _, status, latency in selected if status is not None)
+        print(f"{kind:<10} {len(selected):>8} {errors:>8} {overloaded:>6} "
+              f"{percentile(latencies, 0.50):>8.2f} {percentile(latencies, 0.90):>8.2f} "
+              f"{percentile(latencies, 0.99):>8.2f} {(latencies[-1] if latencies else 0):>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de carga del portal cautivo')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Hilos del pool (motor threaded; 0 = hilo por conexión)')
+    parser.add_argument('--queue-size', type=int, default=256)
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--clients', type=int, default=100, help='Clientes concurrentes en total')
+    parser.add_argument('--processes', type=int, default=4, help='Procesos generadores de carga')
+    parser.add_argument('--duration', type=float, default=10.0, help='Segundos de carga')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('probe=80,login=15,register=5'))
+    parser.add_argument('--keep-alive', action='store_true', help='Reutilizar conexiones')
+    parser.add_argument('--firewall-delay', type=float, default=0.005,
+                        help='Segundos simulados por llamada al firewall')
+    parser.add_argument('--real-sessions', action='store_true',
+                        help='Usar SessionManager real en lugar del falso')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    session_manager = SessionManager() if args.real_sessions else StubSessionManager()
+    common = dict(host='127.0.0.1', port=0, user_manager=StubUserManager(),
+                  session_manager=session_manager,
+                  firewall_manager=StubFirewallManager(args.firewall_delay),
+                  backlog=args.backlog)
+    if args.engine == 'async':
+        server = AsyncCaptivePortalServer(**common)
+    else:
+        server = CaptivePortalServer(workers=args.workers, queue_size=args.queue_size, **common)
+
+    base_rss = rss_kb()
+    server.start()
+    time.sleep(0.2)
+    print(f"Servidor {args.engine} en 127.0.0.1:{server.port} — {args.clients} clientes, "
+          f"{args.processes} procesos, mezcla {args.mix}, keep-alive={args.keep_alive}")
+
+    # Muestreo de hilos y memoria del servidor mientras dura la carga
+    peaks = {'threads': threading.active_count(), 'rss': base_rss}
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            peaks['threads'] = max(peaks['threads'], threading.active_count())
+            peaks['rss'] = max(peaks['rss'], rss_kb())
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    per_process = max(1, args.clients // args.processes)
+    processes = [
+        context.Process(target=client_process,
+                        args=(server.port, args.mix, args.duration, per_process,
+                              args.keep_alive, i, queue))
+        for i in range(args.processes)
+    ]
+
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+    results = []
+    for _ in processes:
+        results.extend(queue.get())
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - start
+
+    sampling.set()
+    sampler.join()
+    server.stop()
+
+    report(results, elapsed, peaks['threads'], peaks['rss'], base_rss)
+    stats = server.get_stats()
+    if stats:
+        print(f"\nPool: {stats}")
+
+
+if __name__ == '__main__':
+    main()
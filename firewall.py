@@ -1,21 +1,758 @@
 import subprocess
 import logging
-from threading import Lock
+import re
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Lock, Thread
+
+# Marca de revocación en FirewallBatch.changes
+_REVOKED = object()
+# Clave ausente en los estados deseados de la reconciliación
+_ABSENT = object()
+
+
+class FirewallBatch:
+    """
+    Lote de cambios de firewall pendientes de aplicar.
+    
+    Acumula las líneas que el backend aplica de una vez (iptables-restore,
+    ipset restore o nft -f), las IPs cuyas conexiones hay que borrar de
+    conntrack y los cambios de estado {ip: mac o _REVOKED} y {ip: tiene
+    reglas de revocación} que se confirman al aplicarse el lote.
+    """
+    
+    def __init__(self):
+        self.rules = []
+        self.set_ops = []
+        self.conntrack = []
+        self.changes = {}
+        self.revocations = {}
+        self.flush_all_conntrack = False
+    
+    def __len__(self):
+        return len(self.changes)
+
+
+class FirewallTransaction:
+    """Transacción explícita devuelta por FirewallManager.transaction()."""
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.ops = []
+        self.flush_all_conntrack = False
+        self.future = None
+    
+    def allow(self, ip_address, mac=None, policy=None):
+        """Añade a la transacción el alta de un cliente."""
+        self.ops.append((self.manager._allow_ops, (ip_address, mac, policy)))
+    
+    def block(self, ip_address):
+        """Añade a la transacción la revocación de un cliente."""
+        self.ops.append((self.manager._block_ops, (ip_address,)))
+    
+    def build(self, batch):
+        """Añade al lote las operaciones de la transacción (hilo del firewall)."""
+        for op, args in self.ops:
+            op(batch, *args)
+
+
+class _FirewallJob:
+    """Petición encolada al hilo del firewall."""
+    
+    __slots__ = ('build', 'call', 'future', 'enqueued')
+    
+    def __init__(self, build, call, future, enqueued):
+        self.build = build
+        self.call = call
+        self.future = future
+        self.enqueued = enqueued
+
+
+class FirewallBackend:
+    """
+    Interfaz de los backends de firewall.
+    
+    Un backend traduce altas y bajas de clientes a operaciones de su
+    herramienta (que se acumulan en un FirewallBatch), sabe aplicar un lote
+    completo con un solo proceso y lee contadores y clientes en bloque.
+    FirewallManager conserva el estado {ip: mac} y decide cuándo aplicar.
+    """
+    
+    name = None
+    
+    def __init__(self, interface, run, capture):
+        """
+        Args:
+            interface: Interfaz de salida a Internet (NAT)
+            run: Función run(command, input=None) -> bool
+            capture: Función capture(command) -> stdout, o None si falla
+        """
+        self.interface = interface
+        self.run = run
+        self.capture = capture
+    
+    def setup(self):
+        """Instala las reglas iniciales."""
+        raise NotImplementedError
+    
+    def teardown(self):
+        """Elimina las reglas instaladas por el portal."""
+        raise NotImplementedError
+    
+    def allow_ops(self, batch, ip_address, mac, policy):
+        """Añade al lote el alta de un cliente."""
+        raise NotImplementedError
+    
+    def block_ops(self, batch, ip_address, mac, installed, revoke):
+        """
+        Añade al lote la baja de un cliente.
+        
+        Args:
+            installed: True si el cliente tiene reglas instaladas (con esa mac)
+            revoke: True para añadir las reglas propias de una revocación
+                (False si se sustituye la regla por un re-login o la IP ya
+                las tiene)
+        """
+        raise NotImplementedError
+    
+    def unrevoke_ops(self, batch, ip_address):
+        """Añade al lote el borrado de las reglas de revocación de una IP (si el backend las usa)."""
+    
+    def reconcile_ops(self, batch, desired):
+        """
+        Lee en bloque lo instalado y añade al lote solo la diferencia con el
+        estado deseado: entradas duplicadas, sobrantes o con otra mac/política
+        se borran y las que faltan se añaden.
+        
+        Args:
+            desired: Diccionario {ip: (mac, política)} de los clientes que
+                deben tener acceso
+        
+        Returns:
+            Conjunto de IPs que tenían acceso según la lectura, o None si falla
+        """
+        raise NotImplementedError
+    
+    @staticmethod
+    def _diff_entries(installed, desired):
+        """
+        Compara entradas instaladas con las deseadas.
+        
+        Args:
+            installed: Diccionario {clave: [(valor, entrada), ...]}; puede
+                haber varias entradas por clave (duplicados)
+            desired: Diccionario {clave: valor}
+        
+        Returns:
+            Tupla (entradas que sobran, claves deseadas sin entrada correcta)
+        """
+        extra = []
+        missing = []
+        for key, entries in installed.items():
+            wanted = desired.get(key, _ABSENT)
+            kept = False
+            for value, entry in entries:
+                if not kept and value == wanted:
+                    kept = True
+                else:
+                    extra.append(entry)
+        
+        for key, value in desired.items():
+            if not any(installed_value == value for installed_value, _ in installed.get(key, ())):
+                missing.append(key)
+        return extra, missing
+    
+    def apply(self, batch):
+        """Aplica las operaciones del lote. Devuelve True si se aplicaron."""
+        raise NotImplementedError
+    
+    def read_counters(self):
+        """Devuelve {ip: (paquetes, bytes)} con una sola lectura en bloque."""
+        raise NotImplementedError
+    
+    def list_allowed(self):
+        """Devuelve las IPs con acceso leyendo el firewall en bloque."""
+        raise NotImplementedError
+
+
+class IptablesBackend(FirewallBackend):
+    """
+    Backend clásico: una regla ACCEPT por cliente en una cadena propia del
+    portal y una cadena de contabilidad con dos reglas sin target por cliente.
+    
+    Las reglas por cliente nunca se escriben en FORWARD, así la
+    reconciliación solo toca cadenas del portal y respeta las reglas que
+    el administrador tenga en FORWARD.
+    """
+    
+    name = "iptables"
+    
+    # Cadena de clientes: ACCEPT por cliente y REJECT/DROP de revocaciones.
+    # FORWARD salta a ella antes de aceptar conexiones establecidas, así el
+    # DROP de una revocación sigue cortando lo que quedara abierto
+    CLIENTS_CHAIN = "PORTAL_CLIENTS"
+    # Cadena de contabilidad: una regla sin target por IP y sentido, que
+    # solo cuenta paquetes/bytes y deja seguir la evaluación de FORWARD
+    ACCOUNTING_CHAIN = "PORTAL_ACCT"
+    
+    def _setup_common(self):
+        """Reglas comunes a los backends basados en iptables."""
+        # Permitir tráfico local
+        self.run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+        self.run(["iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"])
+        
+        # Permitir conexiones establecidas y relacionadas SOLO desde el interior (origen)
+        # Esto es más restrictivo que permitir en ambas direcciones
+        self.run([
+            "iptables", "-A", "FORWARD", "-m", "conntrack",
+            "--ctstate", "ESTABLISHED,RELATED", "-j", "ACCEPT"
+        ])
+    
+    def _setup_policy(self):
+        """Política por defecto de FORWARD y NAT."""
+        # Bloquear todo el forwarding por defecto (política DROP)
+        self.run(["iptables", "-P", "FORWARD", "DROP"])
+        
+        # Habilitar NAT para las conexiones autorizadas
+        self.run([
+            "iptables", "-t", "nat", "-A", "POSTROUTING",
+            "-o", self.interface, "-j", "MASQUERADE"
+        ])
+    
+    def setup(self):
+        self._setup_common()
+        
+        # Cadena de contabilidad por IP, evaluada antes que el resto de FORWARD,
+        # y después la cadena de clientes
+        self.run(["iptables", "-N", self.ACCOUNTING_CHAIN])
+        self.run(["iptables", "-N", self.CLIENTS_CHAIN])
+        self.run(["iptables", "-I", "FORWARD", "1", "-j", self.ACCOUNTING_CHAIN])
+        self.run(["iptables", "-I", "FORWARD", "2", "-j", self.CLIENTS_CHAIN])
+        
+        self._setup_policy()
+    
+    def teardown(self):
+        # Establecer políticas por defecto a ACCEPT
+        self.run(["iptables", "-P", "INPUT", "ACCEPT"])
+        self.run(["iptables", "-P", "FORWARD", "ACCEPT"])
+        self.run(["iptables", "-P", "OUTPUT", "ACCEPT"])
+        
+        # Limpiar todas las reglas
+        print("La pinga")
+        self.run(["iptables", "-F"])
+        self.run(["iptables", "-X"])
+        
+        # Limpiar reglas de NAT
+        self.run(["iptables", "-t", "nat", "-F"])
+        self.run(["iptables", "-t", "nat", "-X"])
+    
+    @staticmethod
+    def _match_args(ip_address, mac=None):
+        """Argumentos de iptables que identifican a un cliente: IP y, si se conoce, MAC."""
+        args = ["-s", ip_address]
+        if mac:
+            args += ["-m", "mac", "--mac-source", mac]
+        return args
+    
+    def allow_ops(self, batch, ip_address, mac, policy):
+        # Permitir forwarding desde esta IP (y MAC) y contabilizar su tráfico
+        batch.rules.append(" ".join(["-A", self.CLIENTS_CHAIN] + self._match_args(ip_address, mac) + ["-j", "ACCEPT"]))
+        batch.rules.append(f"-A {self.ACCOUNTING_CHAIN} -s {ip_address}")
+        batch.rules.append(f"-A {self.ACCOUNTING_CHAIN} -d {ip_address}")
+    
+    def block_ops(self, batch, ip_address, mac, installed, revoke):
+        if revoke:
+            # Enviar RST (reset) a todas las conexiones TCP de esta IP
+            batch.rules.append(f"-A {self.CLIENTS_CHAIN} -s {ip_address} -j REJECT --reject-with tcp-reset")
+            # Agregar regla de DROP explícito para bloquear todo tráfico desde esta IP
+            batch.rules.append(f"-I {self.CLIENTS_CHAIN} 1 -s {ip_address} -j DROP")
+        # iptables-restore es atómico: un -D de una regla inexistente
+        # haría fallar el lote entero, así que solo se borra lo instalado
+        if installed:
+            batch.rules.append(" ".join(["-D", self.CLIENTS_CHAIN] + self._match_args(ip_address, mac) + ["-j", "ACCEPT"]))
+            batch.rules.append(f"-D {self.ACCOUNTING_CHAIN} -s {ip_address}")
+            batch.rules.append(f"-D {self.ACCOUNTING_CHAIN} -d {ip_address}")
+    
+    def unrevoke_ops(self, batch, ip_address):
+        # Sin esto el DROP insertado al principio de la cadena bloquearía el re-login
+        batch.rules.append(f"-D {self.CLIENTS_CHAIN} -s {ip_address} -j REJECT --reject-with tcp-reset")
+        batch.rules.append(f"-D {self.CLIENTS_CHAIN} -s {ip_address} -j DROP")
+    
+    def reconcile_ops(self, batch, desired):
+        """
+        Un único 'iptables -S' con todas las reglas de la tabla filter, de
+        las que solo se consideran las de las cadenas del portal (nunca las
+        de FORWARD ni las de otras cadenas del administrador).
+        
+        Además de duplicados y reglas de clientes sin sesión, borra todas las
+        reglas REJECT/DROP por IP que dejaron las revocaciones: conntrack ya
+        cortó esas conexiones y la política DROP bloquea al resto.
+        """
+        output = self.capture(["iptables", "-S"])
+        if output is None:
+            return None
+        
+        clients = {}  # {ip: [(mac, regla)]}
+        accounting = {}  # {(ip, sentido): [(None, regla)]}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != "-A" or parts[2] not in ("-s", "-d"):
+                continue  # Políticas, cadenas y reglas que no son por IP
+            
+            chain, ip = parts[1], parts[3].partition("/")[0]
+            rule = " ".join(parts[1:])
+            if chain == self.ACCOUNTING_CHAIN:
+                accounting.setdefault((ip, parts[2]), []).append((None, rule))
+            elif chain == self.CLIENTS_CHAIN and parts[2] == "-s" and "-j" in parts:
+                target = parts[parts.index("-j") + 1]
+                if target == "ACCEPT":
+                    mac = parts[parts.index("--mac-source") + 1].lower() if "--mac-source" in parts else None
+                    clients.setdefault(ip, []).append((mac, rule))
+                elif target in ("REJECT", "DROP"):
+                    batch.rules.append(f"-D {rule}")
+        
+        extra, missing = self._diff_entries(clients, {ip: mac for ip, (mac, _) in desired.items()})
+        batch.rules.extend(f"-D {rule}" for rule in extra)
+        batch.rules.extend(
+            " ".join(["-A", self.CLIENTS_CHAIN] + self._match_args(ip, desired[ip][0]) + ["-j", "ACCEPT"])
+            for ip in missing
+        )
+        
+        extra, missing = self._diff_entries(
+            accounting, {(ip, direction): None for ip in desired for direction in ("-s", "-d")}
+        )
+        batch.rules.extend(f"-D {rule}" for rule in extra)
+        batch.rules.extend(f"-A {self.ACCOUNTING_CHAIN} {direction} {ip}" for ip, direction in missing)
+        return set(clients)
+    
+    def apply(self, batch):
+        success = True
+        if batch.rules:
+            # --noflush: modificar las reglas existentes sin vaciar la tabla
+            success = self.run(
+                ["iptables-restore", "--noflush"],
+                input="*filter\n" + "\n".join(batch.rules) + "\nCOMMIT\n"
+            )
+        if success and batch.set_ops:
+            success = self.run(["ipset", "restore"], input="\n".join(batch.set_ops) + "\n")
+        return success
+    
+    def read_counters(self):
+        """
+        Un único 'iptables -L PORTAL_ACCT -v -x -n' devuelve los contadores
+        exactos (-x) de todas las reglas de contabilidad; el coste no depende
+        de cuántas consultas por IP harían falta.
+        """
+        output = self.capture(["iptables", "-L", self.ACCOUNTING_CHAIN, "-v", "-x", "-n"])
+        if output is None:
+            return {}
+        return self._parse_counters(output)
+    
+    @staticmethod
+    def _parse_counters(output):
+        """
+        Parsea la salida de 'iptables -L <cadena> -v -x -n'.
+        
+        Las reglas de contabilidad no tienen target, así que la línea queda:
+        pkts bytes prot opt in out source destination
+        """
+        counters = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) < 8 or not parts[0].isdigit():
+                continue  # Cabeceras de la cadena y de columnas
+            
+            source, destination = parts[-2], parts[-1]
+            ip = source if source != '0.0.0.0/0' else destination
+            packets, bytes_ = counters.get(ip, (0, 0))
+            counters[ip] = (packets + int(parts[0]), bytes_ + int(parts[1]))
+        
+        return counters
+    
+    def list_allowed(self):
+        output = self.capture(["iptables", "-L", self.CLIENTS_CHAIN, "-n", "-v"])
+        if output is None:
+            return []
+        
+        allowed_ips = []
+        for line in output.split('\n'):
+            if 'ACCEPT' in line:
+                parts = line.split()
+                if len(parts) > 7:
+                    ip = parts[7]
+                    if ip != '0.0.0.0/0' and ip != 'anywhere':
+                        allowed_ips.append(ip)
+        
+        return allowed_ips
+
+
+class IpsetBackend(IptablesBackend):
+    """
+    Backend iptables + ipset: los clientes viven en sets hash referenciados
+    por reglas fijas, así el coste por paquete no crece con los clientes.
+    """
+    
+    name = "ipset"
+    
+    # Clientes permitidos por IP, por IP+MAC y set de contabilidad con
+    # contadores por entrada
+    ALLOW_SET = "portal_allowed"
+    ALLOW_MAC_SET = "portal_allowed_mac"
+    ACCOUNTING_SET = "portal_acct"
+    
+    def setup(self):
+        """
+        Crea los sets y las reglas fijas que los referencian.
+        
+        Las reglas no cambian al entrar o salir clientes: solo cambia el
+        contenido de los sets (tablas hash en el kernel).
+        
+        Raises:
+            RuntimeError: Si falta ipset (o su soporte en el kernel); se
+                aborta antes de poner FORWARD en DROP sin reglas ACCEPT
+        """
+        self._setup_common()
+        
+        ok = True
+        for name, set_type in ((self.ALLOW_SET, "hash:ip"),
+                               (self.ALLOW_MAC_SET, "hash:ip,mac"),
+                               (self.ACCOUNTING_SET, "hash:ip")):
+            extra = ["counters"] if name == self.ACCOUNTING_SET else []
+            ok = self.run(["ipset", "create", name, set_type, "-exist"] + extra) and ok
+            ok = self.run(["ipset", "flush", name]) and ok
+        
+        # Contabilidad de ambos sentidos al principio de FORWARD (reglas sin target)
+        ok = self.run([
+            "iptables", "-I", "FORWARD", "1",
+            "-m", "set", "--match-set", self.ACCOUNTING_SET, "src"
+        ]) and ok
+        ok = self.run([
+            "iptables", "-I", "FORWARD", "2",
+            "-m", "set", "--match-set", self.ACCOUNTING_SET, "dst"
+        ]) and ok
+        
+        # Una regla ACCEPT por set, sea cual sea el número de clientes
+        ok = self.run([
+            "iptables", "-A", "FORWARD",
+            "-m", "set", "--match-set", self.ALLOW_SET, "src", "-j", "ACCEPT"
+        ]) and ok
+        ok = self.run([
+            "iptables", "-A", "FORWARD",
+            "-m", "set", "--match-set", self.ALLOW_MAC_SET, "src,src", "-j", "ACCEPT"
+        ]) and ok
+        if not ok:
+            raise RuntimeError("No se pudieron crear los sets de ipset y sus reglas "
+                               "(¿está instalado ipset?)")
+        
+        self._setup_policy()
+    
+    def teardown(self):
+        super().teardown()
+        # Los sets solo se pueden destruir cuando ninguna regla los referencia
+        for name in (self.ALLOW_SET, self.ALLOW_MAC_SET, self.ACCOUNTING_SET):
+            self.run(["ipset", "destroy", name])
+    
+    def _set_entry(self, ip_address, mac=None):
+        """Set y entrada de ipset que representan a un cliente."""
+        if mac:
+            return self.ALLOW_MAC_SET, f"{ip_address},{mac}"
+        return self.ALLOW_SET, ip_address
+    
+    def allow_ops(self, batch, ip_address, mac, policy):
+        # Añadir el cliente al set; la regla ACCEPT ya existe
+        batch.set_ops.append("add %s %s -exist" % self._set_entry(ip_address, mac))
+        batch.set_ops.append(f"add {self.ACCOUNTING_SET} {ip_address} -exist")
+    
+    def block_ops(self, batch, ip_address, mac, installed, revoke):
+        # Sacarlo de los sets; no hacen falta reglas REJECT/DROP por IP
+        batch.set_ops.append("del %s %s -exist" % self._set_entry(ip_address, mac))
+        batch.set_ops.append(f"del {self.ACCOUNTING_SET} {ip_address} -exist")
+    
+    def unrevoke_ops(self, batch, ip_address):
+        pass  # Este backend no añade reglas de revocación
+    
+    def reconcile_ops(self, batch, desired):
+        """Un único 'ipset save' con los miembros de todos los sets."""
+        output = self.capture(["ipset", "save"])
+        if output is None:
+            return None
+        
+        clients = {}  # {ip: [(mac, (set, miembro))]}
+        accounting = {}  # {ip: [(None, miembro)]}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) < 3 or parts[0] != "add":
+                continue  # Líneas 'create'
+            
+            name, member = parts[1], parts[2]
+            if name == self.ALLOW_SET:
+                clients.setdefault(member, []).append((None, (name, member)))
+            elif name == self.ALLOW_MAC_SET:
+                ip, _, mac = member.partition(",")
+                clients.setdefault(ip, []).append((mac.lower(), (name, member)))
+            elif name == self.ACCOUNTING_SET:
+                accounting.setdefault(member, []).append((None, member))
+        
+        extra, missing = self._diff_entries(clients, {ip: mac for ip, (mac, _) in desired.items()})
+        batch.set_ops.extend(f"del {name} {member} -exist" for name, member in extra)
+        batch.set_ops.extend("add %s %s -exist" % self._set_entry(ip, desired[ip][0]) for ip in missing)
+        
+        extra, missing = self._diff_entries(accounting, dict.fromkeys(desired))
+        batch.set_ops.extend(f"del {self.ACCOUNTING_SET} {ip} -exist" for ip in extra)
+        batch.set_ops.extend(f"add {self.ACCOUNTING_SET} {ip} -exist" for ip in missing)
+        return set(clients)
+    
+    def read_counters(self):
+        """Un único 'ipset list portal_acct' con los contadores de cada entrada."""
+        output = self.capture(["ipset", "list", self.ACCOUNTING_SET])
+        if output is None:
+            return {}
+        return self._parse_set_counters(output)
+    
+    @staticmethod
+    def _set_members(output):
+        """Devuelve las líneas de la sección 'Members:' de 'ipset list'."""
+        _, _, members = output.partition("Members:")
+        return [line.split() for line in members.splitlines() if line.strip()]
+    
+    @classmethod
+    def _parse_set_counters(cls, output):
+        """
+        Parsea 'ipset list' de un set con contadores.
+        
+        Cada miembro es una línea: <ip> packets <n> bytes <n>
+        """
+        counters = {}
+        for parts in cls._set_members(output):
+            if len(parts) >= 5 and parts[1] == "packets" and parts[3] == "bytes":
+                counters[parts[0]] = (int(parts[2]), int(parts[4]))
+        return counters
+    
+    def list_allowed(self):
+        allowed_ips = []
+        for name in (self.ALLOW_SET, self.ALLOW_MAC_SET):
+            output = self.capture(["ipset", "list", name])
+            if output is not None:
+                allowed_ips.extend(parts[0].split(",")[0] for parts in self._set_members(output))
+        return allowed_ips
+
+
+class NftablesBackend(FirewallBackend):
+    """
+    Backend nftables nativo.
+    
+    Todo vive en la tabla 'inet portal':
+    - set 'acct' (ipv4_addr, con contador por elemento) para la contabilidad;
+    - mapas de veredicto 'clients' (ipv4_addr : veredicto) y 'clients_mac'
+      (ipv4_addr . ether_addr : veredicto). El veredicto es 'accept' o un
+      'jump' a la cadena de la política del usuario.
+    
+    La cadena forward tiene un número fijo de reglas: encontrar al cliente
+    es una consulta al mapa. Cada lote se aplica con un único 'nft -f -',
+    que el kernel confirma de forma atómica.
+    """
+    
+    name = "nftables"
+    TABLE = "inet portal"
+    
+    _COUNTER_RE = re.compile(r'(\d+\.\d+\.\d+\.\d+) counter packets (\d+) bytes (\d+)')
+    _ELEMENT_RE = re.compile(r'(\d+\.\d+\.\d+\.\d+)(?: \. [0-9a-fA-F:]+)? : ')
+    _SECTION_RE = re.compile(r'(?:set|map) (\w+) \{(.*?)\n\s*\}', re.DOTALL)
+    _VERDICT_RE = re.compile(
+        r'(\d+\.\d+\.\d+\.\d+)(?: \. ([0-9a-fA-F:]+))? : (accept|drop|jump \w+|goto \w+)'
+    )
+    _ADDRESS_RE = re.compile(r'\d+\.\d+\.\d+\.\d+')
+    
+    def __init__(self, interface, run, capture, policies=None):
+        """
+        Args:
+            policies: Diccionario {nombre: [reglas nft]} con las cadenas de
+                política por usuario; cada cadena termina aceptando el
+                tráfico que sus reglas no hayan decidido
+        """
+        super().__init__(interface, run, capture)
+        self.policies = policies or {}
+    
+    def setup(self):
+        self.run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+        
+        policy_chains = "".join(
+            f"  chain policy_{name} {{\n" + "".join(f"    {rule}\n" for rule in rules) + "    accept\n  }\n"
+            for name, rules in self.policies.items()
+        )
+        # 'add table' + 'delete table' deja la tabla vacía exista o no
+        ruleset = (
+            f"add table {self.TABLE}\n"
+            f"delete table {self.TABLE}\n"
+            f"table {self.TABLE} {{\n"
+            "  set acct { type ipv4_addr; counter; }\n"
+            "  map clients { type ipv4_addr : verdict; }\n"
+            "  map clients_mac { type ipv4_addr . ether_addr : verdict; }\n"
+            + policy_chains +
+            "  chain input { type filter hook input priority 0; policy accept;\n"
+            "    iifname \"lo\" accept\n"
+            "  }\n"
+            "  chain forward { type filter hook forward priority 0; policy drop;\n"
+            "    ip saddr @acct\n"
+            "    ip daddr @acct\n"
+            "    ct state established,related accept\n"
+            "    ip saddr . ether saddr vmap @clients_mac\n"
+            "    ip saddr vmap @clients\n"
+            "  }\n"
+            "  chain postrouting { type nat hook postrouting priority 100;\n"
+            f"    oifname \"{self.interface}\" masquerade\n"
+            "  }\n"
+            "}\n"
+        )
+        if not self.run(["nft", "-f", "-"], input=ruleset):
+            raise RuntimeError("No se pudo crear la tabla de nftables (¿está instalado nft?)")
+    
+    def teardown(self):
+        self.run(["nft", "delete", "table", "inet", "portal"])
+    
+    def _verdict(self, policy):
+        """Veredicto del mapa para un cliente según su política."""
+        if policy and policy in self.policies:
+            return f"jump policy_{policy}"
+        return "accept"
+    
+    def allow_ops(self, batch, ip_address, mac, policy):
+        verdict = self._verdict(policy)
+        if mac:
+            batch.rules.append(f"add element {self.TABLE} clients_mac {{ {ip_address} . {mac} : {verdict} }}")
+        else:
+            batch.rules.append(f"add element {self.TABLE} clients {{ {ip_address} : {verdict} }}")
+        batch.rules.append(f"add element {self.TABLE} acct {{ {ip_address} }}")
+    
+    def block_ops(self, batch, ip_address, mac, installed, revoke):
+        # nft -f es atómico: borrar un elemento inexistente haría fallar el
+        # lote, así que solo se borra lo que consta como instalado
+        if not installed:
+            return
+        if mac:
+            batch.rules.append(f"delete element {self.TABLE} clients_mac {{ {ip_address} . {mac} }}")
+        else:
+            batch.rules.append(f"delete element {self.TABLE} clients {{ {ip_address} }}")
+        batch.rules.append(f"delete element {self.TABLE} acct {{ {ip_address} }}")
+    
+    def reconcile_ops(self, batch, desired):
+        """Un único 'nft list table' con los elementos de los mapas y del set."""
+        output = self.capture(["nft", "list", "table", "inet", "portal"])
+        if output is None:
+            return None
+        
+        sections = dict(self._SECTION_RE.findall(output))
+        clients = {}  # {ip: [((mac, veredicto), elemento)]}
+        for name in ("clients", "clients_mac"):
+            for ip, mac, verdict in self._VERDICT_RE.findall(sections.get(name, "")):
+                key = f"{ip} . {mac}" if mac else ip
+                clients.setdefault(ip, []).append(((mac.lower() or None, verdict), (name, key)))
+        _, _, acct_elements = sections.get("acct", "").partition("elements")
+        accounting = {ip: [(None, ip)] for ip in self._ADDRESS_RE.findall(acct_elements)}
+        
+        extra, missing = self._diff_entries(
+            clients, {ip: (mac, self._verdict(policy)) for ip, (mac, policy) in desired.items()}
+        )
+        batch.rules.extend(f"delete element {self.TABLE} {name} {{ {key} }}" for name, key in extra)
+        for ip in missing:
+            mac, policy = desired[ip]
+            verdict = self._verdict(policy)
+            if mac:
+                batch.rules.append(f"add element {self.TABLE} clients_mac {{ {ip} . {mac} : {verdict} }}")
+            else:
+                batch.rules.append(f"add element {self.TABLE} clients {{ {ip} : {verdict} }}")
+        
+        extra, missing = self._diff_entries(accounting, dict.fromkeys(desired))
+        batch.rules.extend(f"delete element {self.TABLE} acct {{ {ip} }}" for ip in extra)
+        batch.rules.extend(f"add element {self.TABLE} acct {{ {ip} }}" for ip in missing)
+        return set(clients)
+    
+    def apply(self, batch):
+        if not batch.rules:
+            return True
+        return self.run(["nft", "-f", "-"], input="\n".join(batch.rules) + "\n")
+    
+    def read_counters(self):
+        """Un único 'nft list set' con el contador de cada elemento de 'acct'."""
+        output = self.capture(["nft", "list", "set", "inet", "portal", "acct"])
+        if output is None:
+            return {}
+        return {ip: (int(packets), int(bytes_))
+                for ip, packets, bytes_ in self._COUNTER_RE.findall(output)}
+    
+    def list_allowed(self):
+        allowed_ips = []
+        for name in ("clients", "clients_mac"):
+            output = self.capture(["nft", "list", "map", "inet", "portal", name])
+            if output is not None:
+                allowed_ips.extend(self._ELEMENT_RE.findall(output))
+        return allowed_ips
+
+
+# Backends disponibles por nombre
+BACKENDS = {
+    IptablesBackend.name: IptablesBackend,
+    IpsetBackend.name: IpsetBackend,
+    NftablesBackend.name: NftablesBackend,
+}
+
 
 class FirewallManager:
      
     
-    def __init__(self, interface="eth0"):
-         
+    def __init__(self, interface="eth0", backend="iptables", batch_size=256, batch_delay=0.0,
+                 policies=None, user_policies=None):
+        """
+        Args:
+            interface: Interfaz de salida a Internet (NAT)
+            backend: "iptables" (una regla por cliente), "ipset" (sets hash
+                referenciados por reglas fijas) o "nftables" (set y mapas de
+                veredicto nativos)
+            batch_size: Clientes por lote antes de aplicarlo sin esperar
+            batch_delay: Segundos que el hilo del firewall espera para agrupar
+                cambios en un lote (0 = aplicar lo que haya encolado al momento)
+            policies: {nombre: [reglas nft]} de políticas por usuario (solo nftables)
+            user_policies: {username: nombre de política}
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend de firewall desconocido: {backend}")
+        
         self.interface = interface
-        self.lock = Lock()
+        self.allowed = {}  # {ip: mac o None} con regla ACCEPT instalada (solo lo toca el hilo del firewall)
+        self.revoked = set()  # IPs con reglas de revocación instaladas
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.user_policies = user_policies or {}
         self.logger = logging.getLogger(__name__)
+        
+        # Hilo del firewall: único dueño de las reglas y de self.allowed
+        self.queue = Queue()
+        self.worker = None
+        self.worker_lock = Lock()
+        
+        # Métricas
+        self.stats_lock = Lock()
+        self.processed = 0
+        self.batches = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_apply = 0.0
+        
+        if backend == NftablesBackend.name:
+            self.backend = NftablesBackend(interface, self._run_command, self._capture_command,
+                                           policies=policies)
+        else:
+            self.backend = BACKENDS[backend](interface, self._run_command, self._capture_command)
     
-    def _run_command(self, command):
+    def _run_command(self, command, input=None):
         
         try:
             result = subprocess.run(
                 command,
+                input=input,
                 capture_output=True,
                 text=True,
                 check=False
@@ -29,123 +766,460 @@ class FirewallManager:
             self.logger.error(f"Excepción al ejecutar comando: {e}")
             return False
     
+    def _capture_command(self, command):
+        """Ejecuta un comando de lectura y devuelve su salida (None si falla)."""
+        try:
+            result = subprocess.run(
+                command,
+                capture_output=True,
+                text=True,
+                check=False
+            )
+        except Exception as e:
+            self.logger.error(f"Excepción al ejecutar comando: {e}")
+            return None
+        
+        if result.returncode != 0:
+            self.logger.error(f"Error ejecutando comando: {' '.join(command)}")
+            self.logger.error(f"Error: {result.stderr}")
+            return None
+        return result.stdout
+    
     def setup_initial_rules(self):
          
-        with self.lock:
-            # Permitir tráfico local
-            self._run_command(["sysctl", "-w", "net.ipv4.ip_forward=1"])
-            self._run_command(["iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"])
-            
-            # Permitir conexiones establecidas y relacionadas SOLO desde el interior (origen)
-            # Esto es más restrictivo que permitir en ambas direcciones
-            self._run_command([
-                "iptables", "-A", "FORWARD", "-m", "conntrack",
-                "--ctstate", "ESTABLISHED,RELATED", "-j", "ACCEPT"
-            ])
-            
-            # Bloquear todo el forwarding por defecto (política DROP)
-            self._run_command(["iptables", "-P", "FORWARD", "DROP"])
-            
-            # Habilitar NAT para las conexiones autorizadas
-            self._run_command([
-                "iptables", "-t", "nat", "-A", "POSTROUTING",
-                "-o", self.interface, "-j", "MASQUERADE"
-            ])
-            
-            self.logger.info("Reglas iniciales de firewall configuradas")
+        return self._submit(call=self._setup).result()
     
-    def allow_ip(self, ip_address):
-         
-        with self.lock:
-            # Permitir forwarding desde esta IP
-            success = self._run_command([
-                "iptables", "-A", "FORWARD",
-                "-s", ip_address, "-j", "ACCEPT"
-            ])
+    def _setup(self):
+        """Instala las reglas iniciales (hilo del firewall)."""
+        self.backend.setup()
+        self.logger.info(f"Reglas iniciales de firewall configuradas (backend {self.backend.name})")
+        return True
+    
+    def _is_allowed(self, ip_address, batch):
+        """
+        Indica si una IP tiene regla ACCEPT, contando los cambios aún no aplicados del lote.
+        
+        Returns:
+            Tupla (permitida, mac)
+        """
+        if ip_address in batch.changes:
+            mac = batch.changes[ip_address]
+            return mac is not _REVOKED, (None if mac is _REVOKED else mac)
+        if ip_address in self.allowed:
+            return True, self.allowed[ip_address]
+        return False, None
+    
+    def _is_revoked(self, ip_address, batch):
+        """Indica si una IP tiene reglas de revocación, contando el lote."""
+        return batch.revocations.get(ip_address, ip_address in self.revoked)
+    
+    def _allow_ops(self, batch, ip_address, mac=None, policy=None):
+        """Añade al lote las operaciones que permiten a un cliente."""
+        if self._is_revoked(ip_address, batch):
+            self.backend.unrevoke_ops(batch, ip_address)
+            batch.revocations[ip_address] = False
+        
+        installed, old_mac = self._is_allowed(ip_address, batch)
+        if installed:
+            # Re-login: sustituir la regla en lugar de duplicarla
+            self.backend.block_ops(batch, ip_address, old_mac, installed=True, revoke=False)
+        
+        self.backend.allow_ops(batch, ip_address, mac, policy)
+        batch.changes[ip_address] = mac
+    
+    def _block_ops(self, batch, ip_address):
+        """Añade al lote las operaciones que revocan a un cliente."""
+        installed, mac = self._is_allowed(ip_address, batch)
+        # Las reglas de revocación solo se añaden una vez por IP
+        self.backend.block_ops(batch, ip_address, mac, installed=installed,
+                               revoke=not self._is_revoked(ip_address, batch))
+        batch.revocations[ip_address] = True
+        
+        # Se aplica después de las reglas, así ninguna conexión nueva se
+        # cuela entre el borrado de conntrack y la revocación
+        batch.conntrack.append(ip_address)
+        batch.changes[ip_address] = _REVOKED
+    
+    def _apply(self, batch):
+        """
+        Aplica un lote con el backend (un solo proceso) y después borra de
+        conntrack las conexiones de las IPs revocadas. Solo se llama desde
+        el hilo del firewall, así que no necesita lock.
+        
+        Returns:
+            True si las reglas se aplicaron correctamente
+        """
+        if not batch:
+            return True
+        
+        if not self.backend.apply(batch):
+            self.logger.error(f"Lote de firewall rechazado ({len(batch)} clientes)")
+            return False
+        
+        for ip, mac in batch.changes.items():
+            if mac is _REVOKED:
+                self.allowed.pop(ip, None)
+            else:
+                self.allowed[ip] = mac
+        for ip, revoked in batch.revocations.items():
+            if revoked:
+                self.revoked.add(ip)
+            else:
+                self.revoked.discard(ip)
+        
+        if batch.flush_all_conntrack:
+            self._run_command(["conntrack", "-F"])
+        else:
+            for ip in batch.conntrack:
+                self._run_command(["conntrack", "-D", "-s", ip])
+        
+        allowed = sum(1 for mac in batch.changes.values() if mac is not _REVOKED)
+        self.logger.info(f"Firewall: {allowed} IPs permitidas, "
+                         f"{len(batch.changes) - allowed} bloqueadas en un lote")
+        return True
+    
+    def _submit(self, build=None, call=None):
+        """
+        Encola una petición para el hilo del firewall sin esperar a que se aplique.
+        
+        Args:
+            build: Función que recibe el lote y le añade operaciones; las de
+                varias peticiones seguidas se aplican juntas en un solo lote
+            call: Función sin argumentos que se ejecuta aparte, después de
+                aplicar lo encolado antes (instalación, limpieza, vaciado de
+                conntrack completo)
+        
+        Returns:
+            Future que se resuelve con True/False al aplicarse (o el resultado de call)
+        """
+        future = Future()
+        job = _FirewallJob(build, call, future, time.monotonic())
+        with self.worker_lock:
+            if self.worker is None:
+                self.worker = Thread(target=self._worker_loop, name="firewall-worker", daemon=True)
+                self.worker.start()
+            self.queue.put(job)
+        return future
+    
+    def _worker_loop(self):
+        """
+        Hilo del firewall: saca peticiones de la cola y las aplica por lotes.
+        
+        Toma todo lo que haya encolado (hasta batch_size clientes) y, con
+        batch_delay, espera ese tiempo desde la primera petición del lote
+        por si llegan más. Los procesos externos (iptables-restore, nft,
+        conntrack) solo se lanzan desde aquí, así que ningún handler HTTP
+        espera por ellos.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
             
-            #  "iptables", "-I", "FORWARD", "1",
-            #     "-s", ip_address, "-j", "ACCEPT"
-            if success:
-                self.logger.info(f"IP permitida: {ip_address}")
+            batch, group = FirewallBatch(), []
+            deadline = job.enqueued + self.batch_delay
+            while True:
+                if job is None:
+                    self._finish_group(batch, group)
+                    return
+                
+                if job.future.set_running_or_notify_cancel():
+                    if job.call is not None:
+                        # Respetar el orden: primero lo encolado antes
+                        self._finish_group(batch, group)
+                        batch, group = FirewallBatch(), []
+                        self._run_call(job)
+                    else:
+                        try:
+                            job.build(batch)
+                            group.append(job)
+                        except Exception as e:
+                            self.logger.error(f"Error preparando cambios de firewall: {e}")
+                            self._complete(job, exception=e)
+                
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    job = self.queue.get_nowait()
+                except Empty:
+                    timeout = deadline - time.monotonic()
+                    if not group or timeout <= 0:
+                        break
+                    try:
+                        job = self.queue.get(timeout=timeout)
+                    except Empty:
+                        break
             
-            return success
-
+            self._finish_group(batch, group)
+    
+    def _finish_group(self, batch, group):
+        """Aplica el lote de un grupo de peticiones y resuelve sus futures."""
+        if not group:
+            return
+        
+        start = time.monotonic()
+        results = self._apply_isolating(group, batch)
+        
+        with self.stats_lock:
+            self.batches += 1
+            self.total_apply += time.monotonic() - start
+            self.failed += results.count(False)
+        for job, applied in zip(group, results):
+            self._complete(job, result=applied)
+    
+    def _try_apply(self, batch):
+        """_apply que convierte una excepción en un lote fallido."""
+        try:
+            return self._apply(batch)
+        except Exception as e:
+            self.logger.error(f"Error aplicando lote de firewall: {e}")
+            return False
+    
+    def _build_batch(self, jobs):
+        """Construye de nuevo el lote de unas peticiones sobre el estado actual."""
+        batch = FirewallBatch()
+        for job in jobs:
+            job.build(batch)
+        return batch
+    
+    def _apply_isolating(self, jobs, batch):
+        """
+        Aplica un lote y, si el backend lo rechaza, aísla la petición culpable.
+        
+        iptables-restore y nft -f son atómicos: una sola línea errónea tira
+        el lote entero. Se parte el grupo por la mitad (reconstruyendo cada
+        mitad sobre el estado ya aplicado) hasta dar con la petición que
+        falla, así solo esa se resuelve con False.
+        
+        Returns:
+            Lista de booleanos (aplicada o no) en el orden de jobs
+        """
+        if self._try_apply(batch):
+            return [True] * len(jobs)
+        
+        if len(jobs) > 1:
+            half = len(jobs) // 2
+            return (self._apply_isolating(jobs[:half], self._build_batch(jobs[:half]))
+                    + self._apply_isolating(jobs[half:], self._build_batch(jobs[half:])))
+        
+        # Una sola petición: lo más probable es que el estado local esté
+        # desfasado (un -D de una regla que ya no existe). Se olvida el estado
+        # de sus IPs y se reintenta una vez; lo que sobre lo limpia la reconciliación
+        ips = ", ".join(batch.changes)
+        self.logger.error(f"Cambio de firewall rechazado para {ips}; reintentando sin su estado previo")
+        for ip in batch.changes:
+            self.allowed.pop(ip, None)
+            self.revoked.discard(ip)
+        if self._try_apply(self._build_batch(jobs)):
+            return [True]
+        
+        self.logger.error(f"Cambio de firewall descartado para {ips}")
+        return [False]
+    
+    def _run_call(self, job):
+        """Ejecuta una petición exclusiva y resuelve su future."""
+        try:
+            result = job.call()
+        except Exception as e:
+            self.logger.error(f"Error en operación de firewall: {e}")
+            self._complete(job, exception=e)
+        else:
+            self._complete(job, result=result)
+    
+    def _complete(self, job, result=None, exception=None):
+        """Resuelve el future de una petición y anota su latencia en cola."""
+        latency = time.monotonic() - job.enqueued
+        with self.stats_lock:
+            self.processed += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+    
+    def flush(self):
+        """Espera a que se aplique todo lo encolado hasta ahora."""
+        return self._submit(call=lambda: True).result()
+    
+    def stop(self):
+        """Aplica lo pendiente y detiene el hilo del firewall."""
+        with self.worker_lock:
+            worker, self.worker = self.worker, None
+            if worker is None:
+                return
+            self.queue.put(None)
+        worker.join()
+    
+    def get_stats(self):
+        """
+        Obtiene las métricas del hilo del firewall.
+        
+        Returns:
+            Diccionario con profundidad de cola, peticiones y lotes aplicados,
+            fallos, latencia desde que se encola hasta que se aplica y
+            duración media de cada lote
+        """
+        with self.stats_lock:
+            avg_latency = self.total_latency / self.processed if self.processed else 0.0
+            avg_apply = self.total_apply / self.batches if self.batches else 0.0
+            return {
+                'queue_depth': self.queue.qsize(),
+                'processed': self.processed,
+                'batches': self.batches,
+                'failed': self.failed,
+                'avg_latency_ms': avg_latency * 1000,
+                'max_latency_ms': self.max_latency * 1000,
+                'avg_apply_ms': avg_apply * 1000
+            }
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Agrupa cambios de reglas en un único lote atómico.
+        
+        Uso:
+            with firewall_manager.transaction() as txn:
+                txn.allow(ip, mac)
+                txn.block(otra_ip)
+            txn.future.result()  # opcional: esperar a que se aplique
+        
+        Al salir del bloque (si no hubo excepción) la transacción se encola
+        entera y se aplica con una sola invocación del backend, sean cuantos
+        sean los cambios.
+        """
+        transaction = FirewallTransaction(self)
+        yield transaction
+        if transaction.flush_all_conntrack:
+            # Vaciar conntrack entero afecta a todos: lote propio
+            transaction.future = self._submit(call=lambda: self._apply_transaction(transaction))
+        else:
+            transaction.future = self._submit(build=transaction.build)
+    
+    def _apply_transaction(self, transaction):
+        """Aplica una transacción en un lote propio (hilo del firewall)."""
+        batch = FirewallBatch()
+        transaction.build(batch)
+        batch.flush_all_conntrack = transaction.flush_all_conntrack
+        return self._apply(batch)
+    
+    def allow_ip(self, ip_address, mac=None, username=None):
+        """
+        Permite el tráfico de un cliente.
+        
+        Args:
+            ip_address: IP del cliente
+            mac: MAC del cliente; si se indica, la regla exige ambas y una IP
+                suplantada desde otro equipo no obtiene acceso
+            username: Usuario del cliente, para aplicar su política (user_policies)
+        
+        Returns:
+            Future que se resuelve con True si la regla se instaló
+        """
+        policy = self.user_policies.get(username)
+        return self._submit(build=lambda batch: self._allow_ops(batch, ip_address, mac, policy))
+    
     def block_ip(self, ip_address):
          
-        with self.lock:
-            # Primero, eliminar conexiones establecidas de esta IP usando conntrack
-            # Esto cierra inmediatamente los sockets TCP/UDP activos
-            self._run_command([
-                "conntrack", "-D", "-s", ip_address
-            ])
-            
-            # Enviar RST (reset) a todas las conexiones TCP de esta IP
-            # Para cerrar más agresivamente las conexiones existentes
-            self._run_command([
-                "iptables", "-A", "FORWARD",
-                "-s", ip_address, "-j", "REJECT", "--reject-with", "tcp-reset"
-            ])
-            
-            # Agregar regla de DROP explícito para bloquear todo tráfico desde esta IP
-            self._run_command([
-                "iptables", "-I", "FORWARD", "1",
-                "-s", ip_address, "-j", "DROP"
-            ])
-            
-            # También eliminar la regla de ACCEPT si existe
-            self._run_command([
-                "iptables", "-D", "FORWARD",
-                "-s", ip_address, "-j", "ACCEPT"
-            ])
-            
-            # Flush las conexiones de conntrack una vez más para asegurar
-            self._run_command([
-                "conntrack", "-D", "-s", ip_address
-            ])
-            
-            self.logger.info(f"IP bloqueada y conexiones establecidas eliminadas: {ip_address}")
-            
-            return True
+        return self._submit(build=lambda batch: self._block_ops(batch, ip_address))
+    
+    def block_ips(self, ip_addresses, flush_all_conntrack=False):
+        """
+        Revoca varias IPs en un solo lote.
+        
+        Args:
+            ip_addresses: Iterable de direcciones IP
+            flush_all_conntrack: Vaciar toda la tabla conntrack con un solo
+                'conntrack -F' en lugar de un borrado por IP (al revocar a
+                todos los clientes, p. ej. al detener el portal)
+        
+        Returns:
+            Future que se resuelve con True si las reglas se aplicaron
+        """
+        with self.transaction() as txn:
+            for ip in ip_addresses:
+                txn.block(ip)
+            txn.flush_all_conntrack = flush_all_conntrack
+        return txn.future
     
     def clear_rules(self):
          
-        with self.lock:
-            # Establecer políticas por defecto a ACCEPT
-            self._run_command(["iptables", "-P", "INPUT", "ACCEPT"])
-            self._run_command(["iptables", "-P", "FORWARD", "ACCEPT"])
-            self._run_command(["iptables", "-P", "OUTPUT", "ACCEPT"])
-            
-            # Limpiar todas las reglas
-            print("La pinga")
-            self._run_command(["iptables", "-F"])
-            self._run_command(["iptables", "-X"])
-            
-            # Limpiar reglas de NAT
-            self._run_command(["iptables", "-t", "nat", "-F"])
-            self._run_command(["iptables", "-t", "nat", "-X"])
-            self._run_command(["sysctl", "-w", "net.ipv4.ip_forward=0"])
-            self.logger.info("Reglas de firewall limpiadas")
+        return self._submit(call=self._clear).result()
+    
+    def _clear(self):
+        """Elimina las reglas del portal (hilo del firewall)."""
+        self.backend.teardown()
+        self._run_command(["sysctl", "-w", "net.ipv4.ip_forward=0"])
+        self.allowed.clear()
+        self.revoked.clear()
+        self.logger.info("Reglas de firewall limpiadas")
+        return True
+    
+    def reconcile(self, get_desired):
+        """
+        Reconcilia las reglas instaladas con el estado deseado.
+        
+        Se encola como cualquier otro cambio, así que ve aplicado todo lo
+        anterior, y el estado deseado se obtiene ya en el hilo del firewall:
+        un alta o baja encolada después se aplica sobre el resultado.
+        
+        Args:
+            get_desired: Función que devuelve {ip: (mac, username)} de los
+                clientes que deben tener acceso (las sesiones activas)
+        
+        Returns:
+            Future que se resuelve con el número de operaciones aplicadas
+            (0 si no había diferencias), o None si falló
+        """
+        return self._submit(call=lambda: self._reconcile(get_desired()))
+    
+    def _reconcile(self, desired):
+        """Calcula y aplica en un lote la diferencia con lo instalado (hilo del firewall)."""
+        desired = {
+            ip: (mac.lower() if mac else None, self.user_policies.get(username))
+            for ip, (mac, username) in desired.items()
+        }
+        batch = FirewallBatch()
+        installed = self.backend.reconcile_ops(batch, desired)
+        if installed is None:
+            self.logger.error("Reconciliación de firewall: no se pudo leer el estado instalado")
+            return None
+        
+        operations = len(batch.rules) + len(batch.set_ops)
+        if operations and not self.backend.apply(batch):
+            self.logger.error(f"Reconciliación de firewall descartada ({operations} operaciones)")
+            return None
+        
+        self.allowed = {ip: mac for ip, (mac, _) in desired.items()}
+        self.revoked.clear()
+        # Clientes que tenían acceso sin sesión: cortar también sus conexiones
+        for ip in installed - desired.keys():
+            self._run_command(["conntrack", "-D", "-s", ip])
+        
+        if operations:
+            self.logger.info(f"Reconciliación de firewall: {operations} operaciones para "
+                             f"{len(desired)} clientes activos")
+        return operations
+    
+    def read_counters(self):
+        """
+        Lee los contadores de tráfico de todas las IPs en una sola llamada.
+        
+        Cada backend hace una única lectura en bloque (cadena de
+        contabilidad, set de ipset o set de nftables con contadores por
+        elemento); el coste no depende del número de clientes.
+        
+        Returns:
+            Diccionario {ip: (paquetes, bytes)} acumulados en ambos sentidos
+        """
+        return self.backend.read_counters()
     
     def list_allowed_ips(self):
          
         try:
-            result = subprocess.run(
-                ["iptables", "-L", "FORWARD", "-n", "-v"],
-                capture_output=True,
-                text=True,
-                check=False
-            )
-            
-            allowed_ips = []
-            for line in result.stdout.split('\n'):
-                if 'ACCEPT' in line and 'state ESTABLISHED,RELATED' not in line:
-                    parts = line.split()
-                    if len(parts) > 7:
-                        ip = parts[7]
-                        if ip != '0.0.0.0/0' and ip != 'anywhere':
-                            allowed_ips.append(ip)
-            
-            return allowed_ips
+            return self.backend.list_allowed()
         except Exception as e:
             self.logger.error(f"Error listando IPs permitidas: {e}")
-            return []
\ No newline at end of file
+            return []
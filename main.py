@@ -10,8 +10,11 @@ import os
 from users import UserManager
 from sessions import SessionManager
 from firewall import FirewallManager
+from accounting import TrafficCollector
+from reconciler import FirewallReconciler
+from arp import ArpCache
 
-from server import CaptivePortalServer
+from server import CaptivePortalServer, AsyncCaptivePortalServer
 
 # Hilo para servidor DNS falso
 class DNSFakeServerThread(Thread):
@@ -55,10 +58,21 @@ class DNSFakeServerThread(Thread):
 class CaptivePortal:
      
     
-    def __init__(self, interface="eth0", port=80, session_timeout=3600, gateway_ip=None):
+    def __init__(self, interface="eth0", port=80, session_timeout=3600, gateway_ip=None,
+                 engine="threaded", backlog=128, workers=0, queue_size=256,
+                 cleanup_interval=5, activity_granularity=0, session_journal=None,
+                 warm_restart=False, snapshot_interval=300, accounting_interval=30,
+                 daily_quota=None, max_devices_per_user=1, evict_oldest_device=False,
+                 bind_mac=False, firewall_backend="iptables", firewall_batch_delay=0.0,
+                 firewall_policies=None, user_policies=None, reconcile_interval=60):
          
         self.interface = interface
         self.port = port
+        self.cleanup_interval = cleanup_interval
+        # Arranque en caliente: restaurar sesiones del journal al iniciar y
+        # no revocarlas al detener (requiere session_journal)
+        self.warm_restart = warm_restart and session_journal is not None
+        self.snapshot_interval = snapshot_interval
         
         # Configurar logging
         logging.basicConfig(
@@ -71,8 +85,30 @@ class CaptivePortal:
         self.logger.info("Inicializando componentes del portal cautivo...")
         
         self.user_manager = UserManager()
-        self.session_manager = SessionManager(session_timeout=session_timeout)
-        self.firewall_manager = FirewallManager(interface=interface)
+        self.session_manager = SessionManager(session_timeout=session_timeout,
+                                              activity_granularity=activity_granularity,
+                                              # El journal solo sirve para el arranque en caliente:
+                                              # sin él no se paga escritura a disco en cada login
+                                              journal_path=session_journal if self.warm_restart else None,
+                                              daily_quota=daily_quota,
+                                              max_devices_per_user=max_devices_per_user,
+                                              evict_oldest=evict_oldest_device)
+        self.firewall_manager = FirewallManager(interface=interface, backend=firewall_backend,
+                                                batch_delay=firewall_batch_delay,
+                                                policies=firewall_policies,
+                                                user_policies=user_policies)
+        # Actividad de red (contadores del firewall) para la expiración por inactividad
+        self.traffic_collector = None
+        if accounting_interval:
+            self.traffic_collector = TrafficCollector(
+                self.firewall_manager, self.session_manager, interval=accounting_interval
+            )
+        # Reconciliación periódica de reglas con las sesiones activas
+        self.reconciler = None
+        if reconcile_interval:
+            self.reconciler = FirewallReconciler(
+                self.firewall_manager, self.session_manager, interval=reconcile_interval
+            )
         
         # Usar IP de gateway proporcionada o usar default
         if gateway_ip is None:
@@ -82,13 +118,33 @@ class CaptivePortal:
         
         self.logger.info(f"IP del Gateway (Portal): {self.gateway_ip}")
         
-        self.server = CaptivePortalServer(
-            host=self.gateway_ip,
-            port=port,
-            user_manager=self.user_manager,
-            session_manager=self.session_manager,
-            firewall_manager=self.firewall_manager
-        )
+        # Caché de la tabla ARP para ligar sesiones y reglas a la MAC del cliente
+        self.arp_cache = ArpCache() if bind_mac else None
+        
+        # Motor del servidor HTTP: hilo por conexión o bucle asyncio
+        self.logger.info(f"Motor del servidor HTTP: {engine}")
+        if engine == "async":
+            self.server = AsyncCaptivePortalServer(
+                host=self.gateway_ip,
+                port=port,
+                user_manager=self.user_manager,
+                session_manager=self.session_manager,
+                firewall_manager=self.firewall_manager,
+                backlog=backlog,
+                arp_cache=self.arp_cache
+            )
+        else:
+            self.server = CaptivePortalServer(
+                host=self.gateway_ip,
+                port=port,
+                user_manager=self.user_manager,
+                session_manager=self.session_manager,
+                firewall_manager=self.firewall_manager,
+                backlog=backlog,
+                workers=workers,
+                queue_size=queue_size,
+                arp_cache=self.arp_cache
+            )
         self.dns_thread = DNSFakeServerThread(ip_gateway=self.gateway_ip)
         
         # Hilo para limpieza de sesiones
@@ -126,15 +182,26 @@ class CaptivePortal:
         
         # Configurar firewall
         self.setup()
+        # Restaurar sesiones previas o empezar con el journal vacío
+        self._restore_sessions()
         # Iniciar servidor DNS falso para detección automática
         self.logger.info("Iniciando servidor DNS falso para detección automática de portal cautivo...")
         self.dns_thread.start()
+        # Iniciar caché ARP antes de atender peticiones
+        if self.arp_cache is not None:
+            self.arp_cache.start()
         # Iniciar servidor HTTP
         self.server.start()
         # Iniciar hilo de limpieza de sesiones
         self.running = True
         self.cleanup_thread = Thread(target=self._cleanup_sessions_loop, daemon=True)
         self.cleanup_thread.start()
+        # Iniciar recolector de tráfico
+        if self.traffic_collector is not None:
+            self.traffic_collector.start()
+        # Iniciar reconciliador de reglas
+        if self.reconciler is not None:
+            self.reconciler.start()
         self.logger.info(f"Portal cautivo activo en puerto {self.port}")
         self.logger.info(f"Interfaz de red: {self.interface}")
         self.logger.info(f"Usuarios registrados: {len(self.user_manager.list_users())}")
@@ -151,27 +218,80 @@ class CaptivePortal:
         # Detener servidor DNS falso
         self.logger.info("Deteniendo servidor DNS falso...")
         self.dns_thread.stop()
-        # Detener hilo de limpieza
+        # Detener hilo de limpieza y recolector de tráfico
         self.running = False
-        # Bloquear todas las IPs autenticadas
-        self.logger.info("Revocando accesos...")
-        for ip in list(self.session_manager.sessions.keys()):
-            self.firewall_manager.block_ip(ip)
+        if self.traffic_collector is not None:
+            self.traffic_collector.stop()
+        if self.reconciler is not None:
+            self.reconciler.stop()
+        if self.arp_cache is not None:
+            self.arp_cache.stop()
+        if self.warm_restart:
+            # Guardar las sesiones para restaurarlas en el próximo arranque
+            # en lugar de revocarlas (evita que todos vuelvan a loguearse a la vez)
+            count = self.session_manager.compact()
+            self.logger.info(f"Sesiones guardadas para el reinicio: {count}")
+        else:
+            # Bloquear todas las IPs autenticadas en un solo lote; como se
+            # revoca a todos, conntrack se vacía de una vez
+            self.logger.info("Revocando accesos...")
+            self.firewall_manager.block_ips(self.session_manager.get_all_ips(),
+                                            flush_all_conntrack=True)
+        self.session_manager.close()
         # Limpiar reglas de firewall
         self.logger.info("Limpiando reglas de firewall...")
         self.firewall_manager.clear_rules()
+        self.firewall_manager.stop()
         self.logger.info("Portal cautivo detenido correctamente")
     
+    def _restore_sessions(self):
+        """
+        Restaura las sesiones del journal y reinstala sus reglas en bloque.
+        
+        Sin arranque en caliente se compacta el journal con el estado actual
+        (vacío), descartando las sesiones de la ejecución anterior.
+        """
+        if not self.warm_restart:
+            self.session_manager.compact()
+            return
+        
+        restored = self.session_manager.restore()
+        self.logger.info(f"Sesiones restauradas del journal: {len(restored)}")
+        if restored:
+            # Reconciliar en lugar de añadir: tras una caída pueden quedar
+            # reglas de la ejecución anterior que no hay que duplicar. Se
+            # espera a que estén instaladas antes de atender peticiones
+            self.firewall_manager.reconcile(self.session_manager.get_active_clients).result()
+        self.session_manager.compact()
+    
     def _cleanup_sessions_loop(self):
          
+        last_snapshot = time.monotonic()
         while self.running:
-            time.sleep(60)  # Verificar cada minuto
+            # La limpieza solo toca las sesiones que vencen (heap de expiración),
+            # así que se puede revisar a menudo sin que el coste crezca con las
+            # sesiones. Se despierta en la próxima expiración posible, con
+            # cleanup_interval como espera máxima
+            delay = self.cleanup_interval
+            next_expiry = self.session_manager.next_expiry()
+            if next_expiry is not None:
+                delay = min(delay, max(next_expiry - time.time(), 0.05))
+            time.sleep(delay)
             
             expired_ips = self.session_manager.cleanup_expired_sessions()
             
             for ip in expired_ips:
                 self.logger.info(f"Sesión expirada para IP: {ip}")
-                self.firewall_manager.block_ip(ip)
+            if expired_ips:
+                self.firewall_manager.block_ips(expired_ips)
+            
+            # Snapshot periódico: compacta el journal y persiste la actividad
+            if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                last_snapshot = time.monotonic()
+                try:
+                    self.session_manager.compact()
+                except OSError as e:
+                    self.logger.error(f"Error compactando el journal de sesiones: {e}")
     
     def status(self):
         
@@ -186,6 +306,27 @@ class CaptivePortal:
         for ip, info in sessions.items():
             self.logger.info(f"  - {ip}: {info['username']} (login: {info['login_time']})")
         
+        # Carga del servidor HTTP (solo con pool de workers)
+        server_stats = self.server.get_stats()
+        if server_stats:
+            self.logger.info(
+                f"Pool HTTP: cola {server_stats['queue_depth']}/{server_stats['queue_size']}, "
+                f"rechazadas {server_stats['rejected']}, "
+                f"espera media {server_stats['avg_wait_ms']:.1f} ms, "
+                f"máx {server_stats['max_wait_ms']:.1f} ms"
+            )
+        
+        # Cola del hilo del firewall
+        firewall_stats = self.firewall_manager.get_stats()
+        self.logger.info(
+            f"Firewall: cola {firewall_stats['queue_depth']}, "
+            f"{firewall_stats['processed']} peticiones en {firewall_stats['batches']} lotes, "
+            f"fallidas {firewall_stats['failed']}, "
+            f"latencia media {firewall_stats['avg_latency_ms']:.1f} ms, "
+            f"máx {firewall_stats['max_latency_ms']:.1f} ms, "
+            f"lote medio {firewall_stats['avg_apply_ms']:.1f} ms"
+        )
+        
         # Usuarios registrados
         users = self.user_manager.list_users()
         self.logger.info(f"\nUsuarios registrados: {len(users)}")
@@ -218,6 +359,28 @@ if __name__ == "__main__":
         PORT = 80                  # Puerto HTTP (requiere privilegios de root)
         SESSION_TIMEOUT = 3600     # 1 hora
         GATEWAY_IP = None          # Dejar None para auto-detectar, o especificar manualmente
+        ENGINE = "threaded"        # "threaded" (hilo por conexión) o "async" (bucle asyncio)
+        BACKLOG = 1024             # Conexiones pendientes en listen()
+        WORKERS = 32               # Hilos del pool HTTP (0 = un hilo por conexión)
+        QUEUE_SIZE = 256           # Conexiones en espera antes de responder 503
+        CLEANUP_INTERVAL = 5       # Segundos máximos entre revisiones de sesiones expiradas
+        ACTIVITY_GRANULARITY = 30  # Segundos mínimos entre actualizaciones de actividad
+        # Journal de sesiones junto a main.py (solo se usa con arranque en caliente)
+        SESSION_JOURNAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.journal")
+        WARM_RESTART = False       # Restaurar sesiones al arrancar (también --warm-restart)
+        SNAPSHOT_INTERVAL = 300    # Segundos entre compactaciones del journal
+        ACCOUNTING_INTERVAL = 30   # Segundos entre lecturas de contadores de tráfico (0 = desactivado)
+        DAILY_QUOTA = None         # Bytes diarios por usuario (None = sin cuota), p. ej. 2 * 1024**3
+        MAX_DEVICES_PER_USER = 2   # Dispositivos (IPs) simultáneos por usuario
+        EVICT_OLDEST_DEVICE = False  # True: un login nuevo desconecta el dispositivo más antiguo
+        BIND_MAC = True            # Ligar sesiones y reglas a la MAC del cliente (anti-suplantación)
+        FIREWALL_BACKEND = "iptables"  # "iptables" (regla por cliente), "ipset" o "nftables" (sets, O(1) por paquete; requieren ipset/nft)
+        FIREWALL_BATCH_DELAY = 0.05  # Segundos para agrupar cambios de firewall en un lote (0 = inmediato)
+        # Políticas por usuario (solo backend nftables): cadenas con reglas nft
+        # a las que salta el mapa de veredicto, p. ej. {"limitada": ["limit rate over 1 mbytes/second drop"]}
+        FIREWALL_POLICIES = {}
+        USER_POLICIES = {}         # {username: nombre de política}
+        RECONCILE_INTERVAL = 60    # Segundos entre reconciliaciones de reglas con sesiones (0 = desactivado)
         
         # Verificar si se ejecuta como root (necesario para iptables y DNS)
         import os
@@ -235,8 +398,12 @@ if __name__ == "__main__":
                 print("Uso: sudo python3 main.py [opciones]")
                 print("\nOpciones:")
                 print("  --gateway-ip IP    Especificar IP del gateway (default: auto-detectar)")
+                print("  --warm-restart     Conservar las sesiones al detener y restaurarlas al arrancar")
                 print("  -h, --help         Mostrar esta ayuda")
                 sys.exit(0)
+
+            if '--warm-restart' in sys.argv:
+                WARM_RESTART = True
         
         # Registrar manejador de señales
         signal.signal(signal.SIGINT, signal_handler)
@@ -247,7 +414,26 @@ if __name__ == "__main__":
             interface=INTERFACE,
             port=PORT,
             session_timeout=SESSION_TIMEOUT,
-            gateway_ip=GATEWAY_IP
+            gateway_ip=GATEWAY_IP,
+            engine=ENGINE,
+            backlog=BACKLOG,
+            workers=WORKERS,
+            queue_size=QUEUE_SIZE,
+            cleanup_interval=CLEANUP_INTERVAL,
+            activity_granularity=ACTIVITY_GRANULARITY,
+            session_journal=SESSION_JOURNAL,
+            warm_restart=WARM_RESTART,
+            snapshot_interval=SNAPSHOT_INTERVAL,
+            accounting_interval=ACCOUNTING_INTERVAL,
+            daily_quota=DAILY_QUOTA,
+            max_devices_per_user=MAX_DEVICES_PER_USER,
+            evict_oldest_device=EVICT_OLDEST_DEVICE,
+            bind_mac=BIND_MAC,
+            firewall_backend=FIREWALL_BACKEND,
+            firewall_batch_delay=FIREWALL_BATCH_DELAY,
+            firewall_policies=FIREWALL_POLICIES,
+            user_policies=USER_POLICIES,
+            reconcile_interval=RECONCILE_INTERVAL
         )
         
         portal.start()
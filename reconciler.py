@@ -0,0 +1,66 @@
+"""
+Módulo de reconciliación del portal cautivo.
+Mantiene las reglas del firewall alineadas con las sesiones activas.
+"""
+
+import logging
+from threading import Thread, Event
+
+
+class FirewallReconciler:
+    """
+    Reconciliador periódico entre SessionManager y el firewall.
+    
+    Las sesiones son el estado deseado. En cada ciclo el firewall lee lo
+    instalado con un único volcado en bloque (iptables -S, ipset save o
+    nft list table), calcula la diferencia y aplica solo esa diferencia en
+    un lote: reglas ACCEPT duplicadas, clientes sin sesión, reglas
+    REJECT/DROP que dejaron las revocaciones y clientes a los que les falta
+    la regla. Así el tamaño de las reglas sigue al número de usuarios
+    activos aunque el portal lleve días encendido.
+    """
+    
+    def __init__(self, firewall_manager, session_manager, interval=60):
+        """
+        Inicializa el reconciliador.
+        
+        Args:
+            firewall_manager: FirewallManager cuyas reglas se reconcilian
+            session_manager: SessionManager con las sesiones activas
+            interval: Segundos entre reconciliaciones
+        """
+        self.firewall_manager = firewall_manager
+        self.session_manager = session_manager
+        self.interval = interval
+        self.stop_event = Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+    
+    def start(self):
+        """Inicia el hilo reconciliador."""
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Detiene el hilo reconciliador."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+    
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                self.logger.error(f"Error reconciliando reglas de firewall: {e}")
+    
+    def reconcile(self):
+        """
+        Ejecuta una reconciliación y espera a que se aplique.
+        
+        Returns:
+            Número de operaciones aplicadas (0 si no había diferencias), o
+            None si no se pudo reconciliar
+        """
+        return self.firewall_manager.reconcile(self.session_manager.get_active_clients).result()
@@ -4,9 +4,16 @@ Módulo del servidor HTTP del portal cautivo.
 Maneja las peticiones HTTP y el endpoint de login usando sockets.
 """
 
+import asyncio
+import gzip
 import socket
 import logging
 import os
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full, Empty
 from threading import Thread, Lock
 from urllib.parse import parse_qs, urlparse, unquote
 
@@ -14,30 +21,303 @@ from urllib.parse import parse_qs, urlparse, unquote
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 
 
+
+def build_raw_response(status, headers, body=b''):
+    """
+    Construye una respuesta HTTP completa en bytes (status + headers + body).
+    
+    Args:
+        status: Código y mensaje, p. ej. "200 OK"
+        headers: Lista de tuplas (nombre, valor)
+        body: Body en bytes
+        
+    Returns:
+        Respuesta lista para enviar con sendall()
+    """
+    lines = [f"HTTP/1.1 {status}"]
+    lines.extend(f"{key}: {value}" for key, value in headers)
+    lines.append(f"Content-Length: {len(body)}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+# Respuesta 503 pre-construida para rechazar conexiones cuando la cola está llena
+SERVICE_UNAVAILABLE_RESPONSE = build_raw_response(
+    "503 Service Unavailable",
+    [('Content-Type', 'text/html'), ('Retry-After', '2'), ('Connection', 'close')],
+    b"<html><body><h1>503 Service Unavailable</h1></body></html>"
+)
+
+# Respuestas "con conexión" que esperan los sistemas operativos en sus URLs de
+# detección de portal cautivo: (status, content-type, body)
+PROBE_ONLINE_RESPONSES = {
+    # Android / Chrome
+    '/generate_204': ('204 No Content', None, b''),
+    '/gen_204': ('204 No Content', None, b''),
+    # Apple (iOS / macOS)
+    '/hotspot-detect.html': (
+        '200 OK', 'text/html',
+        b'<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>'
+    ),
+    '/library/test/success.html': (
+        '200 OK', 'text/html',
+        b'<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>'
+    ),
+    # Windows
+    '/connecttest.txt': ('200 OK', 'text/plain', b'Microsoft Connect Test'),
+    '/ncsi.txt': ('200 OK', 'text/plain', b'Microsoft NCSI'),
+    # Firefox
+    '/success.txt': ('200 OK', 'text/plain', b'success\n'),
+    '/canonical.html': (
+        '200 OK', 'text/html',
+        b'<meta http-equiv="refresh" content="0;url=https://support.mozilla.org/kb/captive-portal"/>'
+    ),
+}
+
+
+# Expresiones compiladas por HTTPRequest.get_header, por nombre de header
+_HEADER_PATTERNS = {}
+
+
 class HTTPRequest:
-    """Clase para parsear y representar una petición HTTP."""
+    """
+    Petición HTTP parseada directamente sobre bytes.
+    
+    Valida la línea de petición y limita el número y la longitud de los
+    headers sin decodificar la petición a str. El diccionario de headers con
+    nombres en minúsculas y el body decodificado solo se construyen la
+    primera vez que se consultan; las sondas que solo miran la línea de
+    petición no pagan ese coste.
+    """
+    
+    def __init__(self, head, body=b'', max_headers=100, max_header_line=8190):
+        """
+        Parsea la línea de petición y valida los límites de headers.
+        
+        Args:
+            head: Bytes (o memoryview) de la línea de petición y headers,
+                incluido o no el terminador vacío
+            body: Bytes del body
+            max_headers: Número máximo de headers
+            max_header_line: Longitud máxima de la línea de petición y de
+                cada header
+            
+        Raises:
+            HTTPReadError: 400 si la línea de petición está mal formada, 431 si
+                se exceden los límites de headers, 505 si la versión no es HTTP/1.x
+        """
+        if isinstance(head, memoryview):
+            head = head.tobytes()
+        self._raw = head
+        self._raw_body = body
+        self._headers = None
+        self._body = None
+        
+        # Línea de petición: MÉTODO SP RUTA SP VERSIÓN
+        line_end = head.find(b'\r\n')
+        if line_end == -1:
+            line_end = len(head)
+        parts = head[:line_end].decode('utf-8', errors='ignore').split(' ')
+        if len(parts) != 3:
+            raise HTTPReadError(400, 'Bad Request')
+        method, path, version = parts
+        if not (method.isalpha() and method.isupper()) or not path:
+            raise HTTPReadError(400, 'Bad Request')
+        if version != 'HTTP/1.1' and version != 'HTTP/1.0':
+            if version.startswith('HTTP/'):
+                raise HTTPReadError(505, 'HTTP Version Not Supported')
+            raise HTTPReadError(400, 'Bad Request')
+        
+        self.method = method
+        self.path = path
+        self.version = version
+        
+        # Límites de headers: se cuentan en C sin separar las líneas
+        header_count = head.count(b'\r\n', line_end + 2)
+        if head.endswith(b'\r\n\r\n'):
+            header_count -= 1
+        elif not head.endswith(b'\r\n') and len(head) > line_end + 2:
+            header_count += 1
+        self._header_count = header_count
+        if self._header_count > max_headers:
+            raise HTTPReadError(431, 'Request Header Fields Too Large')
+        # Solo una cabecera más larga que el límite puede excederlo
+        if len(head) > max_header_line:
+            if max(map(len, head.split(b'\r\n'))) > max_header_line:
+                raise HTTPReadError(431, 'Request Header Fields Too Large')
+    
+    @property
+    def headers(self):
+        """Headers con nombre en minúsculas (se construyen al primer acceso)."""
+        if self._headers is None:
+            headers = {}
+            if self._header_count:
+                # Una sola decodificación (latin-1 es biyectiva con los bytes)
+                lines = self._raw.decode('latin-1').split('\r\n', self._header_count + 1)
+                for line in lines[1:self._header_count + 1]:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+            self._headers = headers
+        return self._headers
+    
+    def get_header(self, name, default=''):
+        """
+        Busca un header concreto sin construir el diccionario completo.
+        
+        Args:
+            name: Nombre del header en minúsculas
+            default: Valor si el header no está
+            
+        Returns:
+            Valor del header (str)
+        """
+        if self._headers is not None:
+            return self._headers.get(name, default)
+        
+        pattern = _HEADER_PATTERNS.get(name)
+        if pattern is None:
+            pattern = re.compile(
+                rb'\r\n[ \t]*' + re.escape(name.encode('latin-1')) + rb'[ \t]*:[ \t]*([^\r\n]*)',
+                re.IGNORECASE
+            )
+            _HEADER_PATTERNS[name] = pattern
+        
+        match = pattern.search(self._raw)
+        if match is None:
+            return default
+        return match.group(1).rstrip().decode('latin-1')
+    
+    @property
+    def body(self):
+        """Body decodificado como texto (se decodifica al primer acceso)."""
+        if self._body is None:
+            self._body = self._raw_body.decode('utf-8', errors='ignore')
+        return self._body
+
+
+class TemplateCache:
+    """
+    Caché en memoria de los templates HTML, ya codificados a bytes.
+    
+    Cada template se lee y codifica una sola vez. Para detectar cambios en
+    disco se consulta el mtime como mucho cada check_interval segundos, así
+    que servir una página no hace E/S de ficheros en el camino caliente.
+    
+    Junto a cada template se guardan sus variantes comprimidas (gzip y
+    deflate), calculadas una sola vez al cargarlo.
+    """
+    
+    ENCODINGS = ('gzip', 'deflate')
+    
+    def __init__(self, templates_dir=TEMPLATES_DIR, check_interval=2.0):
+        """
+        Inicializa la caché.
+        
+        Args:
+            templates_dir: Directorio de los templates
+            check_interval: Segundos entre comprobaciones de mtime (0 = siempre)
+        """
+        self.templates_dir = templates_dir
+        self.check_interval = check_interval
+        self.templates = {}  # {nombre: {'mtime': float, 'data': bytes, 'checked_at': float}}
+        self.variants = {}   # {data: {'gzip': bytes, 'deflate': bytes}}
+        self.lock = Lock()
+    
+    def warm(self, template_names=None):
+        """
+        Precarga templates en la caché (normalmente al arrancar el servidor).
+        
+        Args:
+            template_names: Nombres a cargar; por defecto todos los .html
+            
+        Returns:
+            Número de templates cargados
+        """
+        if template_names is None:
+            try:
+                template_names = [name for name in os.listdir(self.templates_dir)
+                                  if name.endswith('.html')]
+            except OSError as e:
+                logging.error(f"No se pudo listar {self.templates_dir}: {e}")
+                return 0
+        
+        return sum(1 for name in template_names if self.get(name) is not None)
     
-    def __init__(self, raw_request):
-        """Parsea la petición HTTP cruda."""
-        lines = raw_request.split('\r\n')
+    def get(self, template_name):
+        """
+        Obtiene un template codificado en UTF-8.
         
-        # Primera línea: método, path, versión
-        request_line = lines[0].split(' ')
-        self.method = request_line[0]
-        self.path = request_line[1]
-        self.version = request_line[2] if len(request_line) > 2 else 'HTTP/1.1'
+        Args:
+            template_name: Nombre del archivo template
+            
+        Returns:
+            Bytes del template o None si no existe
+        """
+        entry = self.templates.get(template_name)
+        now = time.monotonic()
+        if entry is not None and now - entry['checked_at'] < self.check_interval:
+            return entry['data']
+        
+        with self.lock:
+            return self._refresh(template_name, now)
+    
+    def get_variant(self, data, encoding):
+        """
+        Obtiene la versión comprimida de un template ya cargado.
         
-        # Parsear headers
-        self.headers = {}
-        i = 1
-        while i < len(lines) and lines[i]:
-            if ':' in lines[i]:
-                key, value = lines[i].split(':', 1)
-                self.headers[key.strip().lower()] = value.strip()
-            i += 1
+        Args:
+            data: Bytes devueltos por get()
+            encoding: 'gzip' o 'deflate'
+            
+        Returns:
+            Bytes comprimidos, o None si data no proviene de la caché
+        """
+        variants = self.variants.get(data)
+        if variants is None:
+            return None
+        return variants.get(encoding)
+    
+    @staticmethod
+    def _compress(data):
+        """Calcula las variantes comprimidas de un template."""
+        return {
+            # mtime=0 para que el resultado sea estable entre recargas
+            'gzip': gzip.compress(data, compresslevel=9, mtime=0),
+            'deflate': zlib.compress(data, 9),
+        }
+    
+    def _refresh(self, template_name, now):
+        """Relee el template solo si su mtime cambió desde la última carga."""
+        template_path = os.path.join(self.templates_dir, template_name)
+        entry = self.templates.get(template_name)
+        try:
+            mtime = os.stat(template_path).st_mtime
+            if entry is not None and entry['mtime'] == mtime:
+                entry['checked_at'] = now
+                return entry['data']
+            
+            with open(template_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            logging.error(f"Template no encontrado: {template_path}")
+            old = self.templates.pop(template_name, None)
+            if old is not None:
+                self.variants.pop(old['data'], None)
+            return None
+        except Exception as e:
+            logging.error(f"Error cargando template {template_name}: {e}")
+            return entry['data'] if entry is not None else None
         
-        # Body (después de línea vacía)
-        self.body = '\r\n'.join(lines[i+1:]) if i < len(lines) else ''
+        if entry is not None:
+            logging.info(f"Template recargado: {template_name}")
+            self.variants.pop(entry['data'], None)
+        self.variants[data] = self._compress(data)
+        self.templates[template_name] = {'mtime': mtime, 'data': data, 'checked_at': now}
+        return data
+
+
+# Caché compartida por defecto
+_default_template_cache = TemplateCache()
 
 
 def load_template(template_name):
@@ -50,17 +330,396 @@ def load_template(template_name):
     Returns:
         Contenido del template o None si no existe
     """
-    try:
-        template_path = os.path.join(TEMPLATES_DIR, template_name)
-        if os.path.exists(template_path):
-            with open(template_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        else:
-            logging.error(f"Template no encontrado: {template_path}")
+    data = _default_template_cache.get(template_name)
+    if data is None:
+        return None
+    return data.decode('utf-8')
+
+
+class ProbeRoutes:
+    """
+    Tabla de respuestas pre-serializadas para las URLs de detección de portal.
+    
+    Las sondas de los sistemas operativos llegan en ráfagas; se responden con
+    bytes construidos una sola vez (status + headers + body), sin parsear la
+    petición completa. Los clientes sin sesión reciben una redirección al
+    portal y los autenticados la respuesta "con conexión" de su sistema, para
+    que dejen de sondear.
+    """
+    
+    def __init__(self, portal_url):
+        """
+        Construye todas las respuestas.
+        
+        Args:
+            portal_url: URL del portal a la que redirigir a los no autenticados
+        """
+        self.portal_url = portal_url
+        self.online = {}
+        for path, (status, content_type, body) in PROBE_ONLINE_RESPONSES.items():
+            headers = [('Cache-Control', 'no-cache, no-store, must-revalidate')]
+            if content_type:
+                headers.insert(0, ('Content-Type', content_type))
+            self.online[path.encode('ascii')] = self._variants(status, headers, body)
+        
+        body = f'<html><body><a href="{portal_url}">Portal Cautivo</a></body></html>'.encode('utf-8')
+        self.redirect = self._variants('302 Found', [
+            ('Location', portal_url),
+            ('Content-Type', 'text/html'),
+            ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+        ], body)
+    
+    @staticmethod
+    def _variants(status, headers, body):
+        """Devuelve la respuesta en dos variantes: (keep-alive, close)."""
+        return (
+            build_raw_response(status, headers + [('Connection', 'keep-alive')], body),
+            build_raw_response(status, headers + [('Connection', 'close')], body),
+        )
+    
+    def lookup(self, head):
+        """
+        Busca si la petición es un GET a una URL de sondeo.
+        
+        Args:
+            head: Bytes de la línea de petición y headers
+            
+        Returns:
+            Tupla (respuestas_online, respuestas_redirección) o None
+        """
+        line_end = head.find(b'\r\n')
+        parts = head[:line_end].split(b' ')
+        if len(parts) != 3 or parts[0] != b'GET':
+            return None
+        
+        path = parts[1].split(b'?', 1)[0]
+        online = self.online.get(path)
+        if online is None:
             return None
-    except Exception as e:
-        logging.error(f"Error cargando template {template_name}: {e}")
+        return online, self.redirect
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Elige la codificación de contenido según el header Accept-Encoding.
+    
+    Args:
+        accept_encoding: Valor del header (puede estar vacío)
+        
+    Returns:
+        'gzip', 'deflate' o None si el cliente no acepta ninguna
+    """
+    if not accept_encoding:
         return None
+    
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    
+    wildcard = qualities.get('*', 0.0)
+    for coding in TemplateCache.ENCODINGS:
+        if qualities.get(coding, wildcard) > 0:
+            return coding
+    return None
+
+
+def _version_and_connection(head):
+    """
+    Extrae la versión HTTP y el header Connection de los bytes de cabecera.
+    
+    Args:
+        head: Bytes de la línea de petición y headers
+        
+    Returns:
+        Tupla (versión, valor de Connection) como str
+    """
+    lines = head.split(b'\r\n')
+    version = lines[0].rsplit(b' ', 1)[-1].decode('latin-1')
+    connection = ''
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if sep and name.strip().lower() == b'connection':
+            connection = value.strip().decode('latin-1')
+    return version, connection
+
+
+class HTTPReadError(Exception):
+    """Error al leer una petición; lleva el código HTTP con que responder."""
+    
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def _parse_content_length(head, max_body_size):
+    """
+    Extrae y valida el Content-Length de la cabecera de una petición.
+    
+    Args:
+        head: Bytes de la línea de petición y headers
+        max_body_size: Tamaño máximo de body aceptado
+        
+    Returns:
+        Longitud del body (0 si no hay header)
+        
+    Raises:
+        HTTPReadError: Si el valor no es válido, hay varios valores distintos,
+            excede el límite o la petición usa Transfer-Encoding (no soportado)
+    """
+    length = None
+    for line in head.split(b'\r\n')[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            continue
+        name = name.strip().lower()
+        if name == b'content-length':
+            value = value.strip()
+            if not value.isdigit():
+                raise HTTPReadError(400, 'Bad Request')
+            # Varios Content-Length distintos permiten request smuggling
+            if length is not None and int(value) != length:
+                raise HTTPReadError(400, 'Bad Request')
+            length = int(value)
+        elif name == b'transfer-encoding':
+            raise HTTPReadError(411, 'Length Required')
+    
+    if length is None:
+        return 0
+    if length > max_body_size:
+        raise HTTPReadError(413, 'Payload Too Large')
+    return length
+
+
+class RequestReader:
+    """
+    Lector incremental y acotado de peticiones HTTP sobre un socket.
+    
+    Lee hasta el terminador de headers y después exactamente Content-Length
+    bytes de body, trabajando siempre sobre bytes. Cada fase (espera de la
+    petición, headers y body) tiene su propio plazo total, de modo que un
+    cliente que envía byte a byte (slowloris) no retiene un worker más allá
+    de ese plazo. Los bytes sobrantes (pipelining) se guardan para la
+    siguiente petición.
+    
+    Si se indica is_busy y devuelve True (hay conexiones esperando un worker),
+    todas las fases se recortan a busy_timeout: un worker no se queda
+    esperando a un cliente lento o inactivo mientras otros hacen cola.
+    """
+    
+    # Cada cuánto se vuelve a consultar is_busy durante una espera
+    BUSY_POLL_INTERVAL = 0.25
+    
+    def __init__(self, client_socket, max_header_size=8192, max_body_size=65536,
+                 header_timeout=10.0, body_timeout=10.0, is_busy=None,
+                 busy_timeout=1.0):
+        """
+        Inicializa el lector.
+        
+        Args:
+            client_socket: Socket del cliente
+            max_header_size: Tamaño máximo de línea de petición + headers
+            max_body_size: Tamaño máximo del body
+            header_timeout: Segundos para recibir los headers completos
+            body_timeout: Segundos para recibir el body completo
+            is_busy: Función sin argumentos que indica si el servidor está saturado
+            busy_timeout: Plazo máximo de cada fase mientras is_busy() sea True
+        """
+        self.client_socket = client_socket
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.is_busy = is_busy
+        self.busy_timeout = busy_timeout
+        self.buffer = bytearray()
+    
+    def _recv_until(self, phase_start, deadline):
+        """
+        Recibe un bloque respetando el plazo de la fase actual.
+        
+        Args:
+            phase_start: Instante (monotonic) en que empezó la fase
+            deadline: Instante límite normal de la fase
+            
+        Returns:
+            Bytes recibidos (vacío si el cliente cerró)
+            
+        Raises:
+            socket.timeout: Si se agota el plazo
+        """
+        while True:
+            effective_deadline = deadline
+            if self.is_busy is not None and self.is_busy():
+                effective_deadline = min(deadline, phase_start + self.busy_timeout)
+            
+            remaining = effective_deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+            
+            if self.is_busy is None:
+                self.client_socket.settimeout(remaining)
+                return self.client_socket.recv(8192)
+            
+            # Esperar en tramos cortos para notar si el servidor se satura
+            self.client_socket.settimeout(min(remaining, self.BUSY_POLL_INTERVAL))
+            try:
+                return self.client_socket.recv(8192)
+            except socket.timeout:
+                continue
+    
+    def read_request(self, idle_timeout):
+        """
+        Lee una petición completa.
+        
+        Args:
+            idle_timeout: Segundos a esperar el primer byte de la petición
+            
+        Returns:
+            Tupla (head, body) en bytes, o None si el cliente cerró la conexión
+            o no envió nada dentro de idle_timeout
+            
+        Raises:
+            HTTPReadError: Si la petición excede algún límite o se queda a
+                medias al agotar el plazo de headers o body
+        """
+        # Fase 1: esperar el inicio de la petición (conexión inactiva)
+        if not self.buffer:
+            phase_start = time.monotonic()
+            try:
+                chunk = self._recv_until(phase_start, phase_start + idle_timeout)
+            except socket.timeout:
+                return None
+            if not chunk:
+                return None
+            self.buffer += chunk
+        
+        # Fase 2: headers. Solo se busca el terminador en la parte nueva
+        phase_start = time.monotonic()
+        deadline = phase_start + self.header_timeout
+        search_from = 0
+        while True:
+            head_end = self.buffer.find(b'\r\n\r\n', search_from)
+            if head_end != -1:
+                head_end += 4
+                break
+            if len(self.buffer) > self.max_header_size:
+                raise HTTPReadError(431, 'Request Header Fields Too Large')
+            search_from = max(0, len(self.buffer) - 3)
+            try:
+                chunk = self._recv_until(phase_start, deadline)
+            except socket.timeout:
+                raise HTTPReadError(408, 'Request Timeout')
+            if not chunk:
+                return None
+            self.buffer += chunk
+        
+        if head_end > self.max_header_size:
+            raise HTTPReadError(431, 'Request Header Fields Too Large')
+        
+        head = bytes(self.buffer[:head_end])
+        request_end = head_end + _parse_content_length(head, self.max_body_size)
+        
+        # Fase 3: body, exactamente Content-Length bytes
+        phase_start = time.monotonic()
+        deadline = phase_start + self.body_timeout
+        while len(self.buffer) < request_end:
+            try:
+                chunk = self._recv_until(phase_start, deadline)
+            except socket.timeout:
+                raise HTTPReadError(408, 'Request Timeout')
+            if not chunk:
+                return None
+            self.buffer += chunk
+        
+        body = bytes(self.buffer[head_end:request_end])
+        del self.buffer[:request_end]
+        return head, body
+
+
+class ResponseWriter:
+    """
+    Escritor de respuestas HTTP con envío scatter-gather.
+    
+    Los headers se ensamblan en un bytearray que se reutiliza entre respuestas
+    de la misma conexión, y headers y body salen juntos en una sola llamada
+    sendmsg() sin concatenarlos.
+    """
+    
+    def __init__(self, client_socket):
+        """
+        Inicializa el escritor.
+        
+        Args:
+            client_socket: Socket del cliente (o cualquier objeto con sendall)
+        """
+        self.client_socket = client_socket
+        self.header_buffer = bytearray()
+        self.use_sendmsg = hasattr(client_socket, 'sendmsg')
+    
+    def _build_headers(self, status_code, status_message, headers):
+        """Ensambla status line y headers en el buffer reutilizable."""
+        buf = self.header_buffer
+        try:
+            buf.clear()
+        except BufferError:
+            # Aún hay una vista exportada de un envío fallido: usar otro buffer
+            buf = self.header_buffer = bytearray()
+        
+        buf += b'HTTP/1.1 %d ' % status_code
+        buf += status_message.encode('latin-1')
+        buf += b'\r\n'
+        for key, value in headers.items():
+            buf += key.encode('latin-1')
+            buf += b': '
+            buf += str(value).encode('latin-1')
+            buf += b'\r\n'
+        buf += b'\r\n'
+        return buf
+    
+    def write(self, status_code, status_message, headers, body=b''):
+        """
+        Envía una respuesta completa.
+        
+        Args:
+            status_code: Código de estado HTTP
+            status_message: Mensaje de estado
+            headers: Diccionario de headers
+            body: Body en bytes
+        """
+        buf = self._build_headers(status_code, status_message, headers)
+        self._send_buffers([buf, body] if body else [buf])
+    
+    def _send_buffers(self, buffers):
+        """
+        Envía varios buffers con sendmsg, reanudando tras envíos parciales.
+        
+        sendmsg puede aceptar solo una parte (ventana del cliente llena): se
+        descartan los buffers ya enviados y se recorta el primero pendiente.
+        """
+        if not self.use_sendmsg:
+            self.client_socket.sendall(b''.join(buffers))
+            return
+        
+        views = [memoryview(b) for b in buffers]
+        while views:
+            sent = self.client_socket.sendmsg(views)
+            while sent and views:
+                size = len(views[0])
+                if sent >= size:
+                    sent -= size
+                    views.pop(0)
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
 
 
 class CaptivePortalHandler:
@@ -78,19 +737,107 @@ class CaptivePortalHandler:
         self.client_socket = client_socket
         self.client_address = client_address
         self.server = server
+        self.writer = ResponseWriter(client_socket)
         self.logger = logging.getLogger(__name__)
+        
+        # Estado de la conexión persistente (HTTP/1.1 keep-alive)
+        self.keep_alive = False
+        self.requests_served = 0
     
     def handle(self):
-        """Procesa la petición del cliente."""
+        """Atiende las peticiones del cliente mientras la conexión siga viva."""
+        reader = RequestReader(
+            self.client_socket,
+            max_header_size=self.server.max_header_size,
+            max_body_size=self.server.max_body_size,
+            header_timeout=self.server.header_timeout,
+            body_timeout=self.server.body_timeout,
+            is_busy=self.server.is_busy if self.server.worker_pool else None,
+            busy_timeout=self.server.busy_timeout
+        )
+        # La primera petición tiene un margen mayor que las siguientes
+        idle_timeout = self.server.read_timeout
         try:
-            # Recibir datos del cliente
-            raw_request = self.client_socket.recv(8192).decode('utf-8', errors='ignore')
-            
-            if not raw_request:
-                return
+            while True:
+                try:
+                    parts = reader.read_request(idle_timeout)
+                except HTTPReadError as e:
+                    self.logger.warning(f"{self.client_address[0]} - petición rechazada: {e.status_code} {e.message}")
+                    self.client_socket.settimeout(self.server.body_timeout)
+                    self.send_error(e.status_code, e.message)
+                    return
+                
+                if parts is None:
+                    return
+                
+                head, body = parts
+                self.requests_served += 1
+                
+                # El lector deja en el socket lo que quedaba del plazo de
+                # lectura; la respuesta se escribe con su propio plazo
+                self.client_socket.settimeout(self.server.body_timeout)
+                if not self.try_fast_path(head):
+                    self.process(head, body)
+                
+                if not self.keep_alive or not self.server.running:
+                    return
+                
+                # Entre peticiones solo se espera el tiempo de inactividad
+                idle_timeout = self.server.keep_alive_timeout
+        except (socket.timeout, ConnectionError):
+            pass
+        finally:
+            self.client_socket.close()
+    
+    def try_fast_path(self, head):
+        """
+        Responde las sondas de detección de portal con respuestas pre-construidas.
+        
+        Args:
+            head: Bytes de la línea de petición y headers
             
+        Returns:
+            True si la petición se respondió por esta vía
+        """
+        probe_routes = self.server.probe_routes
+        if probe_routes is None:
+            return False
+        
+        match = probe_routes.lookup(head)
+        if match is None:
+            return False
+        
+        online, redirect = match
+        client_ip = self._get_client_ip()
+        authenticated = self.server.session_manager.is_authenticated(client_ip, self._get_client_mac())
+        responses = online if authenticated else redirect
+        
+        version, connection = _version_and_connection(head)
+        self.keep_alive = self._decide_keep_alive(version, connection)
+        self.client_socket.sendall(responses[0] if self.keep_alive else responses[1])
+        self.logger.debug(f"{client_ip} - sonda de portal (autenticado={authenticated})")
+        return True
+    
+    def process(self, head, body=b''):
+        """
+        Parsea una petición ya recibida y la despacha según su método.
+        
+        Lo usan ambos motores del servidor (hilos y asyncio), de modo que
+        el enrutamiento y las respuestas son idénticos en los dos.
+        
+        Args:
+            head: Bytes de la línea de petición y headers
+            body: Bytes del body
+        """
+        try:
             # Parsear la petición
-            request = HTTPRequest(raw_request)
+            try:
+                request = HTTPRequest(head, body)
+            except HTTPReadError as e:
+                self.logger.warning(f"{self.client_address[0]} - petición rechazada: {e.status_code} {e.message}")
+                self.send_error(e.status_code, e.message)
+                return
+            self.keep_alive = self._wants_keep_alive(request)
             
             self.logger.info(f"{self.client_address[0]} - {request.method} {request.path}")
             
@@ -105,8 +852,54 @@ class CaptivePortalHandler:
         except Exception as e:
             self.logger.error(f"Error manejando petición: {e}")
             self.send_error(500, 'Internal Server Error')
-        finally:
-            self.client_socket.close()
+    
+    def _wants_keep_alive(self, request):
+        """Decide si la conexión debe mantenerse abierta tras esta petición."""
+        return self._decide_keep_alive(request.version, request.get_header('connection'))
+    
+    def _decide_keep_alive(self, version, connection):
+        """
+        Decisión de keep-alive común a la vía rápida y a la normal.
+        
+        HTTP/1.1 es persistente salvo que Connection incluya el token "close";
+        HTTP/1.0 solo si incluye "keep-alive". Además se limita el número de
+        peticiones por conexión.
+        
+        Args:
+            version: Versión HTTP de la petición (str)
+            connection: Valor del header Connection (str, puede estar vacío)
+        """
+        if self.requests_served >= self.server.max_keep_alive_requests:
+            return False
+        
+        # Con conexiones esperando un worker no se retiene este
+        if self.server.is_busy():
+            return False
+        
+        tokens = {token.strip().lower() for token in connection.split(',')}
+        if version == 'HTTP/1.1':
+            return 'close' not in tokens
+        return 'keep-alive' in tokens
+    
+    def _connection_headers(self, headers):
+        """
+        Añade los headers Connection/Keep-Alive según el estado de la conexión.
+        
+        Args:
+            headers: Diccionario de headers de la respuesta
+            
+        Returns:
+            El mismo diccionario con los headers añadidos
+        """
+        if self.keep_alive:
+            headers['Connection'] = 'keep-alive'
+            headers['Keep-Alive'] = (
+                f"timeout={int(self.server.keep_alive_timeout)}, "
+                f"max={self.server.max_keep_alive_requests - self.requests_served}"
+            )
+        else:
+            headers['Connection'] = 'close'
+        return headers
     
     def send_response(self, status_code, status_message, headers, body):
         """
@@ -119,44 +912,58 @@ class CaptivePortalHandler:
             body: Contenido de la respuesta
         """
         try:
-            # Construir respuesta HTTP
-            response = f"HTTP/1.1 {status_code} {status_message}\r\n"
-            
-            # Agregar headers
-            for key, value in headers.items():
-                response += f"{key}: {value}\r\n"
-            
-            response += "\r\n"
-            
-            # Enviar respuesta
-            self.client_socket.sendall(response.encode('utf-8'))
-            
-            # Enviar body si existe
-            if body:
-                if isinstance(body, str):
-                    self.client_socket.sendall(body.encode('utf-8'))
-                else:
-                    self.client_socket.sendall(body)
-                    
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.writer.write(status_code, status_message, headers, body)
         except Exception as e:
             self.logger.error(f"Error enviando respuesta: {e}")
     
     def send_error(self, status_code, message):
-        """Envía una respuesta de error."""
+        """Envía una respuesta de error y marca la conexión para cerrarse."""
+        self.keep_alive = False
+        body = f"<html><body><h1>{status_code} {message}</h1></body></html>"
         headers = {
             'Content-Type': 'text/html',
+            'Content-Length': str(len(body)),
             'Connection': 'close'
         }
-        body = f"<html><body><h1>{status_code} {message}</h1></body></html>"
         self.send_response(status_code, message, headers, body)
     
     def _get_client_ip(self):
         """Obtiene la dirección IP del cliente."""
         return self.client_address[0]
     
+    def _get_client_mac(self):
+        """Obtiene la MAC del cliente desde la caché ARP (None si no hay caché o no se conoce)."""
+        arp_cache = self.server.arp_cache
+        if arp_cache is None:
+            return None
+        return arp_cache.lookup(self.client_address[0])
+    
+    def _allow_client(self, client_ip, client_mac, username):
+        """
+        Encola el alta del cliente en el firewall sin esperar a que se aplique.
+        
+        La respuesta no espera al kernel, pero si la regla se rechaza queda
+        registrado en el log (la reconciliación volverá a instalarla).
+        """
+        logger = self.logger
+        
+        def check(future):
+            try:
+                applied = future.result()
+            except Exception as e:
+                logger.error(f"Error instalando la regla de '{username}' ({client_ip}): {e}")
+                return
+            if not applied:
+                logger.error(f"Regla de firewall rechazada para '{username}' ({client_ip}): "
+                             f"autenticado pero sin acceso")
+        
+        self.server.firewall_manager.allow_ip(client_ip, client_mac, username=username).add_done_callback(check)
+    
     def _get_login_page(self, message=""):
-        """Carga y retorna la página HTML de login desde el template."""
-        html = load_template('index.html')
+        """Retorna la página HTML de login (bytes UTF-8) desde la caché de templates."""
+        html = self.server.template_cache.get('index.html')
         
         if html is None:
             # Fallback si el template no existe
@@ -172,13 +979,13 @@ class CaptivePortalHandler:
     <p>El archivo de template no se encontró.</p>
 </body>
 </html>
-            """
+            """.encode('utf-8')
         
         return html
     
     def _get_success_page(self, username):
-        """Carga y retorna la página HTML de éxito desde el template."""
-        html = load_template('success.html')
+        """Retorna la página HTML de éxito (bytes UTF-8) desde la caché de templates."""
+        html = self.server.template_cache.get('success.html')
         
         if html is None:
             # Fallback si el template no existe
@@ -195,13 +1002,13 @@ class CaptivePortalHandler:
     <p>Has iniciado sesión correctamente.</p>
 </body>
 </html>
-            """
+            """.encode('utf-8')
         
         return html
     
     def _get_register_page(self, message=""):
-        """Carga y retorna la página HTML de registro desde el template."""
-        html = load_template('register.html')
+        """Retorna la página HTML de registro (bytes UTF-8) desde la caché de templates."""
+        html = self.server.template_cache.get('register.html')
         
         if html is None:
             # Fallback si el template no existe
@@ -226,10 +1033,33 @@ class CaptivePortalHandler:
     <p><a href="/">Volver a login</a></p>
 </body>
 </html>
-            """
+            """.encode('utf-8')
         
         return html
     
+    def _encode_body(self, request, body, headers):
+        """
+        Aplica la variante comprimida del template si el cliente la acepta.
+        
+        Args:
+            request: Petición HTTP
+            body: Bytes de la página
+            headers: Headers de la respuesta (se completan Content-Length y
+                Content-Encoding)
+            
+        Returns:
+            Body a enviar
+        """
+        encoding = negotiate_encoding(request.get_header('accept-encoding'))
+        if encoding:
+            encoded = self.server.template_cache.get_variant(body, encoding)
+            if encoded is not None:
+                headers['Content-Encoding'] = encoding
+                body = encoded
+        
+        headers['Content-Length'] = str(len(body))
+        return body
+    
     def do_GET(self, request):
         """Maneja las peticiones HTTP GET."""
         client_ip = self._get_client_ip()
@@ -239,20 +1069,20 @@ class CaptivePortalHandler:
         if parsed_path.path == '/register':
             body = self._get_register_page()
         # Verificar si ya está autenticado
-        elif self.server.session_manager.is_authenticated(client_ip):
+        elif self.server.session_manager.is_authenticated(client_ip, self._get_client_mac()):
             username = self.server.session_manager.get_username_by_ip(client_ip)
             body = self._get_success_page(username)
         else:
             body = self._get_login_page()
         
-        headers = {
+        headers = self._connection_headers({
             'Content-Type': 'text/html; charset=utf-8',
-            'Content-Length': str(len(body.encode('utf-8'))),
             'Cache-Control': 'no-cache, no-store, must-revalidate',
             'Pragma': 'no-cache',
             'Expires': '0',
-            'Connection': 'close'
-        }
+            'Vary': 'Accept-Encoding'
+        })
+        body = self._encode_body(request, body, headers)
         
         self.send_response(200, 'OK', headers, body)
     
@@ -284,8 +1114,9 @@ class CaptivePortalHandler:
                 # Intentar registrar el usuario
                 if self.server.user_manager.register(username, email, password):
                     # Registrar exitoso, crear sesión y autenticar
-                    self.server.session_manager.create_session(client_ip, username)
-                    self.server.firewall_manager.allow_ip(client_ip)
+                    client_mac = self._get_client_mac()
+                    self.server.session_manager.create_session(client_ip, username, client_mac)
+                    self._allow_client(client_ip, client_mac, username)
                     
                     self.logger.info(f"Nuevo usuario registrado: '{username}' desde {client_ip}")
                     body = self._get_success_page(username)
@@ -304,44 +1135,177 @@ class CaptivePortalHandler:
             username = params.get('username', [''])[0]
             password = params.get('password', [''])[0]
             
-            # Verificar si el usuario ya está logueado desde otra IP
-            is_logged_in, other_ip = self.server.session_manager.is_user_already_logged_in(
-                username, 
-                exclude_ip=client_ip
-            )
-            
-            if is_logged_in:
-                # El usuario ya está logueado desde otra IP
-                self.logger.warning(f"Intento de login duplicado para '{username}' desde {client_ip} (ya está logueado desde {other_ip})")
-                body = self._get_login_page(f"Este usuario ya está logueado desde otra dirección IP ({other_ip})")
             # Autenticar usuario
-            elif self.server.user_manager.authenticate(username, password):
-                self.server.session_manager.create_session(client_ip, username)
-                self.server.firewall_manager.allow_ip(client_ip)
-                
-                self.logger.info(f"Usuario '{username}' autenticado desde {client_ip}")
-                body = self._get_success_page(username)
-            else:
+            if not self.server.user_manager.authenticate(username, password):
                 self.logger.warning(f"Intento de login fallido desde {client_ip} con usuario '{username}'")
                 body = self._get_login_page("Usuario o contraseña incorrectos")
+            # Verificar la cuota diaria de tráfico
+            elif self.server.session_manager.is_over_quota(username):
+                self.logger.warning(f"Login de '{username}' rechazado desde {client_ip}: cuota diaria agotada")
+                body = self._get_login_page("Has agotado tu cuota diaria de tráfico")
+            else:
+                # Crear la sesión respetando el límite de dispositivos por usuario
+                client_mac = self._get_client_mac()
+                created, evicted, other_ips = self.server.session_manager.start_session(
+                    client_ip, username, client_mac
+                )
+                for ip in evicted:
+                    self.server.firewall_manager.block_ip(ip)
+                    self.logger.info(f"Dispositivo más antiguo de '{username}' desconectado: {ip}")
+                
+                if not created:
+                    # El usuario ya alcanzó el límite de dispositivos
+                    self.logger.warning(f"Intento de login de '{username}' desde {client_ip} rechazado: límite de dispositivos (conectado desde {', '.join(other_ips)})")
+                    body = self._get_login_page(f"Este usuario ya está conectado en el máximo de dispositivos permitidos ({', '.join(other_ips)})")
+                else:
+                    self._allow_client(client_ip, client_mac, username)
+                    
+                    self.logger.info(f"Usuario '{username}' autenticado desde {client_ip}")
+                    body = self._get_success_page(username)
         
-        headers = {
+        headers = self._connection_headers({
             'Content-Type': 'text/html; charset=utf-8',
-            'Content-Length': str(len(body.encode('utf-8'))),
             'Cache-Control': 'no-cache, no-store, must-revalidate',
             'Pragma': 'no-cache',
             'Expires': '0',
-            'Connection': 'close'
-        }
+            'Vary': 'Accept-Encoding'
+        })
+        body = self._encode_body(request, body, headers)
         
         self.send_response(200, 'OK', headers, body)
 
 
+class WorkerPool:
+    """
+    Pool de hilos de tamaño fijo con una cola de conexiones acotada.
+    
+    Sustituye al hilo-por-conexión: el hilo aceptador encola los sockets y
+    un número fijo de workers los atiende. Si la cola está llena, submit()
+    devuelve False para que el servidor rechace la conexión al momento.
+    """
+    
+    def __init__(self, handler, num_workers=32, queue_size=256):
+        """
+        Inicializa el pool.
+        
+        Args:
+            handler: Función handler(client_socket, client_address)
+            num_workers: Número de hilos worker
+            queue_size: Máximo de conexiones en espera de un worker
+        """
+        self.handler = handler
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.queue = Queue(maxsize=queue_size)
+        self.workers = []
+        self.running = False
+        self.logger = logging.getLogger(__name__)
+        
+        # Métricas
+        self.stats_lock = Lock()
+        self.processed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def start(self):
+        """Arranca los hilos worker."""
+        self.running = True
+        for i in range(self.num_workers):
+            worker = Thread(target=self._worker_loop, name=f"portal-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def submit(self, client_socket, client_address):
+        """
+        Encola una conexión para ser atendida.
+        
+        Returns:
+            True si se encoló, False si la cola está llena
+        """
+        try:
+            self.queue.put_nowait((client_socket, client_address, time.monotonic()))
+            return True
+        except Full:
+            with self.stats_lock:
+                self.rejected += 1
+            return False
+    
+    def _worker_loop(self):
+        """Bucle de cada worker: saca conexiones de la cola y las atiende."""
+        while self.running:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except Empty:
+                continue
+            
+            if item is None:
+                break
+            
+            client_socket, client_address, enqueued_at = item
+            wait = time.monotonic() - enqueued_at
+            with self.stats_lock:
+                self.processed += 1
+                self.total_wait += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+            
+            try:
+                self.handler(client_socket, client_address)
+            except Exception as e:
+                self.logger.error(f"Error en worker atendiendo {client_address}: {e}")
+    
+    def stop(self):
+        """Detiene los workers y cierra las conexiones que quedaron encoladas."""
+        self.running = False
+        
+        # Descartar lo pendiente para no dejar sockets abiertos
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                try:
+                    item[0].close()
+                except OSError:
+                    pass
+        
+        for worker in self.workers:
+            worker.join(timeout=2)
+        self.workers = []
+    
+    def get_stats(self):
+        """
+        Obtiene las métricas del pool.
+        
+        Returns:
+            Diccionario con profundidad de cola, rechazos y tiempos de espera
+        """
+        with self.stats_lock:
+            avg_wait = self.total_wait / self.processed if self.processed else 0.0
+            return {
+                'workers': self.num_workers,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue_size,
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'avg_wait_ms': avg_wait * 1000,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+
 class CaptivePortalServer:
     """Servidor HTTP del portal cautivo usando sockets."""
     
     def __init__(self, host='0.0.0.0', port=80, user_manager=None, 
-                 session_manager=None, firewall_manager=None):
+                 session_manager=None, firewall_manager=None, backlog=128,
+                 workers=0, queue_size=256, shed_overload=False,
+                 read_timeout=10.0, keep_alive_timeout=5.0,
+                 max_keep_alive_requests=100, header_timeout=10.0,
+                 body_timeout=10.0, max_header_size=8192, max_body_size=65536,
+                 template_cache=None, probe_fast_path=True, busy_timeout=1.0,
+                 arp_cache=None):
         """
         Inicializa el servidor del portal cautivo.
         
@@ -351,30 +1315,100 @@ class CaptivePortalServer:
             user_manager: Instancia de UserManager
             session_manager: Instancia de SessionManager
             firewall_manager: Instancia de FirewallManager
+            backlog: Tamaño de la cola de conexiones pendientes de listen()
+            workers: Hilos del pool de workers (0 = un hilo por conexión)
+            queue_size: Conexiones máximas esperando un worker
+            shed_overload: Si es True, con la cola llena se cierra la conexión
+                sin responder en lugar de enviar un 503
+            read_timeout: Segundos máximos esperando la primera petición
+            keep_alive_timeout: Segundos de inactividad antes de cerrar una
+                conexión persistente
+            max_keep_alive_requests: Peticiones máximas por conexión
+            header_timeout: Segundos para recibir los headers de una petición
+            body_timeout: Segundos para recibir el body de una petición
+            max_header_size: Bytes máximos de línea de petición + headers
+            max_body_size: Bytes máximos de body
+            template_cache: TemplateCache a usar (por defecto la compartida)
+            probe_fast_path: Responder las URLs de sondeo de los sistemas
+                operativos con respuestas pre-construidas
+            busy_timeout: Plazo de lectura (espera, headers y body) cuando
+                hay conexiones esperando en la cola del pool
+            arp_cache: ArpCache para ligar las sesiones a la MAC del cliente
+                (None = sesiones solo por IP)
         """
         self.host = host
         self.port = port
         self.user_manager = user_manager
         self.session_manager = session_manager
         self.firewall_manager = firewall_manager
+        self.backlog = backlog
+        self.shed_overload = shed_overload
+        self.read_timeout = read_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.template_cache = template_cache if template_cache is not None else _default_template_cache
+        self.probe_fast_path = probe_fast_path
+        self.probe_routes = None
+        self.busy_timeout = busy_timeout
+        self.arp_cache = arp_cache
+        self.worker_pool = None
+        if workers > 0:
+            self.worker_pool = WorkerPool(self._handle_client, workers, queue_size)
         self.server_socket = None
         self.running = False
         self.server_thread = None
         self.logger = logging.getLogger(__name__)
     
+    def _create_server_socket(self):
+        """Crea, enlaza y pone a escuchar el socket del servidor."""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        # Bind y listen
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(self.backlog)
+        
+        # Si se pidió el puerto 0, guardar el puerto real asignado
+        self.port = server_socket.getsockname()[1]
+        return server_socket
+    
+    def _prepare_responses(self):
+        """
+        Precarga templates y construye las respuestas de sondeo.
+        
+        Se llama tras enlazar el socket para conocer el puerto real.
+        """
+        loaded = self.template_cache.warm()
+        self.logger.info(f"Templates precargados en memoria: {loaded}")
+        
+        if self.probe_fast_path:
+            self.probe_routes = ProbeRoutes(self._portal_url())
+    
+    def _portal_url(self):
+        """URL a la que se redirige a los clientes no autenticados."""
+        if self.host in ('', '0.0.0.0'):
+            # Sin IP concreta, el DNS falso resuelve cualquier dominio al portal
+            return '/'
+        if self.port == 80:
+            return f"http://{self.host}/"
+        return f"http://{self.host}:{self.port}/"
+    
     def start(self):
         """Inicia el servidor HTTP."""
         try:
             # Crear socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            
-            # Bind y listen
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket = self._create_server_socket()
+            self._prepare_responses()
             
             self.running = True
             
+            if self.worker_pool:
+                self.worker_pool.start()
+            
             # Ejecutar en un hilo separado
             self.server_thread = Thread(target=self._accept_connections, daemon=True)
             self.server_thread.start()
@@ -397,6 +1431,12 @@ class CaptivePortalServer:
                 try:
                     client_socket, client_address = self.server_socket.accept()
                     
+                    if self.worker_pool:
+                        # Encolar para el pool; si está lleno, rechazar ya
+                        if not self.worker_pool.submit(client_socket, client_address):
+                            self._reject_overload(client_socket)
+                        continue
+                    
                     # Manejar cada cliente en un hilo separado
                     client_thread = Thread(
                         target=self._handle_client,
@@ -423,6 +1463,47 @@ class CaptivePortalServer:
         handler = CaptivePortalHandler(client_socket, client_address, self)
         handler.handle()
     
+    def _reject_overload(self, client_socket):
+        """
+        Rechaza una conexión cuando el pool está saturado.
+        
+        Args:
+            client_socket: Socket del cliente
+        """
+        try:
+            if not self.shed_overload:
+                # Envío no bloqueante: si el buffer del socket no lo admite, se descarta
+                client_socket.setblocking(False)
+                client_socket.send(SERVICE_UNAVAILABLE_RESPONSE)
+                client_socket.shutdown(socket.SHUT_WR)
+                # Vaciar la petición ya recibida para que close() no envíe un RST
+                # que haría perder el 503 en el cliente
+                client_socket.recv(8192)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+    
+    def is_busy(self):
+        """
+        Indica si hay conexiones esperando un worker libre.
+        
+        Mientras sea True los workers no mantienen conexiones keep-alive
+        inactivas ni esperan a clientes lentos más de busy_timeout.
+        """
+        return self.worker_pool is not None and self.worker_pool.queue.qsize() > 0
+    
+    def get_stats(self):
+        """
+        Obtiene las métricas del servidor.
+        
+        Returns:
+            Métricas del pool de workers, o None si se usa un hilo por conexión
+        """
+        if self.worker_pool:
+            return self.worker_pool.get_stats()
+        return None
+    
     def stop(self):
         """Detiene el servidor HTTP."""
         self.logger.info("Deteniendo servidor HTTP...")
@@ -437,6 +1518,256 @@ class CaptivePortalServer:
         if self.server_thread:
             self.server_thread.join(timeout=5)
         
+        if self.worker_pool:
+            self.worker_pool.stop()
+        
+        self.logger.info("Servidor HTTP detenido")
+
+
+class _ResponseBuffer:
+    """
+    Sustituto de socket que acumula en memoria lo que el handler envía.
+    
+    Permite reutilizar CaptivePortalHandler desde el bucle asyncio: el
+    handler escribe con sendall() y el motor vuelca el buffer al transporte.
+    """
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def sendall(self, data):
+        self.chunks.append(bytes(data))
+    
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        size = 0
+        for data in buffers:
+            self.chunks.append(bytes(data))
+            size += len(data)
+        return size
+    
+    def getvalue(self):
+        return b''.join(self.chunks)
+    
+    def clear(self):
+        self.chunks = []
+    
+    def close(self):
+        pass
+
+
+class AsyncCaptivePortalServer(CaptivePortalServer):
+    """
+    Motor alternativo del servidor basado en asyncio (selectors).
+    
+    Multiplexa todos los sockets de clientes en un único bucle de eventos en
+    lugar de crear un hilo por conexión, de modo que miles de sondas de
+    detección de portal concurrentes no disparan el uso de memoria. Las
+    peticiones POST (login, registro, logout) ejecutan llamadas bloqueantes
+    al firewall, así que se despachan a un pool de hilos acotado.
+    """
+    
+    def __init__(self, host='0.0.0.0', port=80, user_manager=None,
+                 session_manager=None, firewall_manager=None, backlog=1024,
+                 max_blocking_workers=8, read_timeout=10.0,
+                 keep_alive_timeout=5.0, max_keep_alive_requests=100,
+                 header_timeout=10.0, body_timeout=10.0, max_header_size=8192,
+                 max_body_size=65536, template_cache=None, probe_fast_path=True,
+                 arp_cache=None):
+        """
+        Inicializa el servidor asyncio.
+        
+        Args:
+            host: Dirección en la que escuchar
+            port: Puerto en el que escuchar
+            user_manager: Instancia de UserManager
+            session_manager: Instancia de SessionManager
+            firewall_manager: Instancia de FirewallManager
+            backlog: Tamaño de la cola de conexiones pendientes de listen()
+            max_blocking_workers: Hilos para las peticiones que tocan el firewall
+            read_timeout: Segundos máximos esperando la primera petición
+            keep_alive_timeout: Segundos de inactividad antes de cerrar una
+                conexión persistente
+            max_keep_alive_requests: Peticiones máximas por conexión
+            header_timeout: Segundos para recibir los headers de una petición
+            body_timeout: Segundos para recibir el body de una petición
+            max_header_size: Bytes máximos de línea de petición + headers
+            max_body_size: Bytes máximos de body
+            template_cache: TemplateCache a usar (por defecto la compartida)
+            probe_fast_path: Responder las URLs de sondeo de los sistemas
+                operativos con respuestas pre-construidas
+            arp_cache: ArpCache para ligar las sesiones a la MAC del cliente
+        """
+        super().__init__(host, port, user_manager, session_manager,
+                         firewall_manager, backlog,
+                         read_timeout=read_timeout,
+                         keep_alive_timeout=keep_alive_timeout,
+                         max_keep_alive_requests=max_keep_alive_requests,
+                         header_timeout=header_timeout,
+                         body_timeout=body_timeout,
+                         max_header_size=max_header_size,
+                         max_body_size=max_body_size,
+                         template_cache=template_cache,
+                         probe_fast_path=probe_fast_path,
+                         arp_cache=arp_cache)
+        self.max_blocking_workers = max_blocking_workers
+        self.loop = None
+        self.executor = None
+        self._stop_event = None
+    
+    def start(self):
+        """Inicia el bucle de eventos en un hilo separado."""
+        try:
+            self.server_socket = self._create_server_socket()
+            self.server_socket.setblocking(False)
+            self._prepare_responses()
+            
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_blocking_workers,
+                thread_name_prefix='portal-blocking'
+            )
+            self.loop = asyncio.new_event_loop()
+            self.running = True
+            
+            self.server_thread = Thread(target=self._run_loop, daemon=True)
+            self.server_thread.start()
+            
+            self.logger.info(f"Servidor HTTP (asyncio) iniciado en {self.host}:{self.port}")
+            
+        except Exception as e:
+            self.logger.error(f"Error iniciando servidor: {e}")
+            raise
+    
+    def _run_loop(self):
+        """Ejecuta el bucle de eventos hasta que se detenga el servidor."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except Exception as e:
+            if self.running:
+                self.logger.error(f"Error en el bucle de eventos: {e}")
+        finally:
+            self.loop.close()
+    
+    async def _serve(self):
+        """Acepta conexiones hasta recibir la señal de parada."""
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(
+            self._handle_connection,
+            sock=self.server_socket,
+            backlog=self.backlog,
+            limit=self.max_header_size
+        )
+        self.logger.info("Esperando conexiones...")
+        async with server:
+            await self._stop_event.wait()
+    
+    async def _handle_connection(self, reader, writer):
+        """
+        Atiende una conexión de cliente dentro del bucle de eventos.
+        
+        Args:
+            reader: asyncio.StreamReader de la conexión
+            writer: asyncio.StreamWriter de la conexión
+        """
+        client_address = writer.get_extra_info('peername')
+        buffer = _ResponseBuffer()
+        handler = CaptivePortalHandler(buffer, client_address, self)
+        idle_timeout = self.read_timeout
+        try:
+            while self.running:
+                try:
+                    head, body = await self._read_request(reader, idle_timeout)
+                except HTTPReadError as e:
+                    handler.send_error(e.status_code, e.message)
+                    writer.write(buffer.getvalue())
+                    await writer.drain()
+                    break
+                
+                handler.requests_served += 1
+                
+                if handler.try_fast_path(head):
+                    pass
+                elif head.startswith(b'POST'):
+                    # Login/registro/logout llaman a iptables: fuera del bucle
+                    await self.loop.run_in_executor(self.executor, handler.process, head, body)
+                else:
+                    handler.process(head, body)
+                
+                writer.write(buffer.getvalue())
+                buffer.clear()
+                await writer.drain()
+                
+                if not handler.keep_alive:
+                    break
+                idle_timeout = self.keep_alive_timeout
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.error(f"Error manejando conexión de {client_address}: {e}")
+        finally:
+            writer.close()
+    
+    async def _read_request(self, reader, idle_timeout):
+        """
+        Lee una petición con los mismos límites y plazos que RequestReader.
+        
+        Args:
+            reader: asyncio.StreamReader de la conexión
+            idle_timeout: Segundos a esperar el primer byte de la petición
+            
+        Returns:
+            Tupla (head, body) en bytes
+            
+        Raises:
+            asyncio.TimeoutError: Si la conexión sigue inactiva tras idle_timeout
+            asyncio.IncompleteReadError: Si el cliente cierra a medias
+            HTTPReadError: Si la petición excede límites o plazos
+        """
+        # Esperar el primer byte sin consumirlo del buffer del reader
+        first = await asyncio.wait_for(reader.read(1), idle_timeout)
+        if not first:
+            raise asyncio.IncompleteReadError(b'', None)
+        
+        try:
+            rest = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.header_timeout)
+        except asyncio.LimitOverrunError:
+            raise HTTPReadError(431, 'Request Header Fields Too Large')
+        except asyncio.TimeoutError:
+            raise HTTPReadError(408, 'Request Timeout')
+        
+        head = first + rest
+        length = _parse_content_length(head, self.max_body_size)
+        body = b''
+        if length:
+            try:
+                body = await asyncio.wait_for(reader.readexactly(length), self.body_timeout)
+            except asyncio.TimeoutError:
+                raise HTTPReadError(408, 'Request Timeout')
+        return head, body
+    
+    def stop(self):
+        """Detiene el bucle de eventos y libera el pool de hilos."""
+        self.logger.info("Deteniendo servidor HTTP...")
+        self.running = False
+        
+        if self.loop and self._stop_event:
+            try:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass
+        
+        if self.server_thread:
+            self.server_thread.join(timeout=5)
+        
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        
+        if self.server_socket:
+            try:
+                self.server_socket.close()
+            except:
+                pass
+        
         self.logger.info("Servidor HTTP detenido")
 
 
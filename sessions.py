@@ -1,108 +1,525 @@
+import heapq
+import itertools
+import json
+import logging
+import os
 import time
-from threading import Lock
-from datetime import datetime, timedelta
+from threading import Lock, Condition, Thread
+from datetime import datetime, timedelta, date
+
+
+class _Session:
+    """Registro compacto de una sesión (sin __dict__ por instancia)."""
+    
+    __slots__ = ('username', 'login_time', 'last_activity', 'expiry_seq', 'bytes_used', 'mac')
+    
+    def __init__(self, username, login_time, mac=None):
+        self.username = username
+        self.mac = mac
+        self.login_time = login_time
+        self.last_activity = login_time
+        self.expiry_seq = 0
+        self.bytes_used = 0
+
+
+def _format_timestamp(timestamp):
+    """Formatea un timestamp como 'YYYY-mm-dd HH:MM:SS' (fuera de cualquier lock)."""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _SessionShard:
+    """
+    Partición del almacén de sesiones con su propio lock.
+    
+    Cada shard guarda las sesiones de las IPs que le caen por hash y su
+    propio heap de expiración, de modo que hilos que atienden IPs de shards
+    distintos no compiten por el mismo lock.
+    """
+    
+    def __init__(self):
+        self.sessions = {}  # {ip_address: _Session}
+        # Min-heap de expiración con borrado perezoso: [(vence, seq, ip)].
+        # Solo la entrada cuyo seq coincide con el de la sesión es válida.
+        self.expiry_heap = []
+        self.lock = Lock()
+
 
 class SessionManager:
      
     
-    def __init__(self, session_timeout=3600):
-         
-        self.sessions = {}  # {ip_address: {'username': str, 'login_time': float, 'last_activity': float}}
-        self.lock = Lock()
+    def __init__(self, session_timeout=3600, shards=16, activity_granularity=0, journal_path=None,
+                 daily_quota=None, max_devices_per_user=1, evict_oldest=False):
+        """
+        Args:
+            session_timeout: Segundos de inactividad tras los que expira una sesión
+            shards: Número de particiones (cada una con su lock)
+            activity_granularity: Segundos mínimos entre escrituras de
+                last_activity. Con 0 se registra cada petición; con N > 0
+                las peticiones dentro de esa ventana solo leen, sin lock, y
+                una sesión expira entre timeout - N y timeout segundos
+                después de su última petición real.
+            journal_path: Archivo del journal de sesiones (None = sin persistencia).
+                Se usan también journal_path + '.snap' (última compactación)
+                y journal_path + '.old' (journal en curso de compactación).
+            daily_quota: Bytes diarios por usuario (None = sin cuota)
+            max_devices_per_user: Sesiones simultáneas (IPs) por usuario
+            evict_oldest: Al superar el límite, cerrar la sesión más antigua
+                en lugar de rechazar el nuevo login
+        """
+        self.max_devices_per_user = max_devices_per_user
+        self.evict_oldest = evict_oldest
+        self.login_lock = Lock()  # Serializa start_session para respetar el límite
+        self.daily_quota = daily_quota
+        self.daily_usage = {}  # {username: bytes consumidos hoy}
+        self.usage_day = date.today()
+        self.usage_lock = Lock()
+        self.activity_granularity = activity_granularity
+        self.journal_path = journal_path
+        self.journal_file = None
+        # Registros pendientes de escribir. journal_lock solo protege la lista
+        # (orden de locks: shard -> journal_lock); el archivo lo protege
+        # journal_file_lock (orden: journal_file_lock -> journal_lock)
+        self.journal_pending = []
+        self.journal_lock = Lock()
+        self.journal_ready = Condition(self.journal_lock)
+        self.journal_file_lock = Lock()
+        self.journal_writer = None
+        self.journal_stopping = False
+        self.logger = logging.getLogger(__name__)
+        self.shards = [_SessionShard() for _ in range(max(1, shards))]
+        # Índice secundario {username: set(ip_address)} con lock propio.
+        # Orden de locks: primero el del shard, después index_lock (nunca al revés).
+        self.user_index = {}
+        self.index_lock = Lock()
+        self.expiry_seq = itertools.count()
         self.session_timeout = session_timeout
     
-    def create_session(self, ip_address, username):
-         
-        with self.lock:
+    def _shard(self, ip_address):
+        """Devuelve el shard al que pertenece una IP."""
+        return self.shards[hash(ip_address) % len(self.shards)]
+    
+    def create_session(self, ip_address, username, mac=None):
+        """
+        Crea (o reemplaza) la sesión de una IP.
+        
+        Args:
+            ip_address: IP del cliente
+            username: Nombre del usuario
+            mac: MAC del cliente; si se indica, la sesión solo es válida
+                para peticiones que lleguen desde esa MAC
+        """
+        shard = self._shard(ip_address)
+        with shard.lock:
             current_time = time.time()
-            self.sessions[ip_address] = {
-                'username': username,
-                'login_time': current_time,
-                'last_activity': current_time
-            }
+            # Si la IP ya tenía sesión (quizá de otro usuario), sacarla del índice
+            if ip_address in shard.sessions:
+                self._remove_session(shard, ip_address)
+            session = shard.sessions[ip_address] = _Session(username, current_time, mac)
+            with self.index_lock:
+                self.user_index.setdefault(username, set()).add(ip_address)
+            self._schedule_expiry(shard, ip_address, session)
+            self._journal_append(self._create_record(ip_address, session))
             return True
     
-    def is_authenticated(self, ip_address):
-         
-        with self.lock:
-            if ip_address not in self.sessions:
+    def start_session(self, ip_address, username, mac=None):
+        """
+        Crea una sesión respetando el límite de dispositivos por usuario.
+        
+        Si la IP ya pertenece al usuario, se renueva la sesión sin contar
+        como dispositivo nuevo. El coste depende solo de los dispositivos del
+        usuario (índice por usuario), no del total de sesiones.
+        
+        Args:
+            ip_address: IP del nuevo dispositivo
+            username: Nombre del usuario
+            mac: MAC del dispositivo (ver create_session)
+            
+        Returns:
+            Tupla (creada, ips_desalojadas, ips_activas_del_usuario)
+        """
+        with self.login_lock:
+            devices = [(login_time, ip) for login_time, ip in self._active_devices_of(username)
+                       if ip != ip_address]
+            
+            evicted = []
+            excess = len(devices) - self.max_devices_per_user + 1
+            if excess > 0:
+                if not self.evict_oldest:
+                    return False, [], [ip for _, ip in devices]
+                # Desalojar los dispositivos más antiguos
+                for _, ip in devices[:excess]:
+                    if self.end_session(ip):
+                        evicted.append(ip)
+            
+            self.create_session(ip_address, username, mac)
+            return True, evicted, []
+    
+    def _schedule_expiry(self, shard, ip_address, session):
+        """
+        Añade al heap del shard la entrada de expiración de una sesión.
+        
+        La actividad posterior no toca el heap: al vencer la entrada se
+        comprueba last_activity y, si la sesión sigue viva, se reprograma.
+        Debe llamarse con shard.lock adquirido.
+        """
+        seq = next(self.expiry_seq)
+        session.expiry_seq = seq
+        heapq.heappush(shard.expiry_heap,
+                       (session.last_activity + self.session_timeout, seq, ip_address))
+    
+    def _remove_session(self, shard, ip_address):
+        """
+        Elimina una sesión manteniendo el índice por usuario consistente.
+        
+        Debe llamarse con shard.lock adquirido.
+        """
+        session = shard.sessions.pop(ip_address)
+        with self.index_lock:
+            ips = self.user_index.get(session.username)
+            if ips is not None:
+                ips.discard(ip_address)
+                if not ips:
+                    del self.user_index[session.username]
+        return session
+    
+    def is_authenticated(self, ip_address, mac=None):
+        """
+        Verifica si una IP tiene sesión vigente y registra su actividad.
+        
+        Args:
+            ip_address: IP del cliente
+            mac: MAC desde la que llega la petición. Si la sesión está ligada
+                a otra MAC (IP suplantada) no se considera autenticada; si es
+                None (MAC desconocida) solo se comprueba la IP.
+        """
+        shard = self._shard(ip_address)
+        
+        # Vía sin lock: si la actividad registrada es reciente (menos de
+        # activity_granularity) la sesión está vigente y no hace falta escribir.
+        # dict.get y la lectura de un atributo son atómicos con el GIL.
+        if self.activity_granularity:
+            session = shard.sessions.get(ip_address)
+            if (session is not None and time.time() - session.last_activity < self.activity_granularity
+                    and (mac is None or session.mac is None or session.mac == mac)):
+                return True
+        
+        with shard.lock:
+            session = shard.sessions.get(ip_address)
+            if session is None:
+                return False
+            
+            # MAC distinta de la ligada a la sesión: no se toca la sesión legítima
+            if mac is not None and session.mac is not None and session.mac != mac:
                 return False
             
-            session = self.sessions[ip_address]
             current_time = time.time()
             
             # Verificar si la sesión ha expirado
-            if current_time - session['last_activity'] > self.session_timeout:
-                del self.sessions[ip_address]
+            if current_time - session.last_activity > self.session_timeout:
+                self._remove_session(shard, ip_address)
                 return False
             
             # Actualizar última actividad
-            session['last_activity'] = current_time
+            session.last_activity = current_time
             return True
     
+    def record_activity(self, ip_addresses, timestamp=None):
+        """
+        Marca actividad en varias sesiones a la vez (p. ej. tráfico visto en el firewall).
+        
+        Las IPs se agrupan por shard para tomar cada lock una sola vez. Las
+        IPs sin sesión se ignoran; no se resucitan sesiones ya expiradas.
+        
+        Args:
+            ip_addresses: Iterable de direcciones IP con actividad
+            timestamp: Instante de la actividad (por defecto, ahora)
+            
+        Returns:
+            Número de sesiones actualizadas
+        """
+        current_time = time.time() if timestamp is None else timestamp
+        by_shard = {}
+        for ip in ip_addresses:
+            by_shard.setdefault(self._shard(ip), []).append(ip)
+        
+        updated = 0
+        for shard, ips in by_shard.items():
+            with shard.lock:
+                for ip in ips:
+                    session = shard.sessions.get(ip)
+                    if session is None or session.last_activity >= current_time:
+                        continue
+                    if current_time - session.last_activity > self.session_timeout:
+                        continue  # Ya expirada: la purgará la limpieza
+                    session.last_activity = current_time
+                    updated += 1
+        
+        return updated
+    
+    def record_usage(self, ip_bytes):
+        """
+        Suma bytes transferidos a las sesiones y a la cuota diaria de sus usuarios.
+        
+        Args:
+            ip_bytes: Diccionario {ip: bytes transferidos desde la última muestra}
+            
+        Returns:
+            Lista de IPs con sesión de usuarios que superaron la cuota diaria
+        """
+        by_shard = {}
+        for ip, delta in ip_bytes.items():
+            by_shard.setdefault(self._shard(ip), []).append((ip, delta))
+        
+        per_user = {}
+        for shard, items in by_shard.items():
+            with shard.lock:
+                for ip, delta in items:
+                    session = shard.sessions.get(ip)
+                    if session is None:
+                        continue
+                    session.bytes_used += delta
+                    per_user[session.username] = per_user.get(session.username, 0) + delta
+        
+        over_quota = []
+        with self.usage_lock:
+            self._roll_usage_day()
+            for username, delta in per_user.items():
+                total = self.daily_usage.get(username, 0) + delta
+                self.daily_usage[username] = total
+                if self.daily_quota is not None and total > self.daily_quota:
+                    over_quota.append(username)
+        
+        ips = []
+        for username in over_quota:
+            ips.extend(self._active_ips_of(username))
+        return ips
+    
+    def _roll_usage_day(self):
+        """
+        Reinicia el consumo diario al cambiar de día.
+        
+        Debe llamarse con self.usage_lock adquirido.
+        """
+        today = date.today()
+        if today != self.usage_day:
+            self.daily_usage.clear()
+            self.usage_day = today
+    
+    def get_daily_usage(self, username):
+        """
+        Obtiene los bytes consumidos hoy por un usuario.
+        
+        Args:
+            username: Nombre del usuario
+            
+        Returns:
+            Bytes consumidos en el día actual
+        """
+        with self.usage_lock:
+            self._roll_usage_day()
+            return self.daily_usage.get(username, 0)
+    
+    def is_over_quota(self, username):
+        """
+        Verifica si un usuario superó su cuota diaria de tráfico.
+        
+        Args:
+            username: Nombre del usuario
+            
+        Returns:
+            True si hay cuota configurada y se ha superado
+        """
+        if self.daily_quota is None:
+            return False
+        return self.get_daily_usage(username) > self.daily_quota
+    
     def get_session_info(self, ip_address):
          
-        with self.lock:
-            if ip_address not in self.sessions:
+        shard = self._shard(ip_address)
+        with shard.lock:
+            session = shard.sessions.get(ip_address)
+            if session is None:
                 return None
-            
-            session = self.sessions[ip_address]
-            return {
-                'username': session['username'],
-                'login_time': datetime.fromtimestamp(session['login_time']).strftime('%Y-%m-%d %H:%M:%S'),
-                'last_activity': datetime.fromtimestamp(session['last_activity']).strftime('%Y-%m-%d %H:%M:%S'),
-                'active': time.time() - session['last_activity'] <= self.session_timeout
-            }
+            username, login_time, last_activity = session.username, session.login_time, session.last_activity
+            bytes_used = session.bytes_used
+        
+        # El formateo de fechas se hace fuera del lock
+        return {
+            'username': username,
+            'login_time': _format_timestamp(login_time),
+            'last_activity': _format_timestamp(last_activity),
+            'active': time.time() - last_activity <= self.session_timeout,
+            'bytes_used': bytes_used
+        }
     
     def end_session(self, ip_address):
          
-        with self.lock:
-            if ip_address in self.sessions:
-                del self.sessions[ip_address]
+        shard = self._shard(ip_address)
+        with shard.lock:
+            if ip_address in shard.sessions:
+                self._remove_session(shard, ip_address)
+                self._journal_append({'op': 'end', 'ip': ip_address})
                 return True
             return False
     
     def get_all_sessions(self):
          
-        with self.lock:
-            result = {}
-            current_time = time.time()
-            
-            # Crear copia de las sesiones para no mantener el lock demasiado tiempo
-            for ip, session in list(self.sessions.items()):
-                if current_time - session['last_activity'] <= self.session_timeout:
-                    result[ip] = {
-                        'username': session['username'],
-                        'login_time': datetime.fromtimestamp(session['login_time']).strftime('%Y-%m-%d %H:%M:%S'),
-                        'last_activity': datetime.fromtimestamp(session['last_activity']).strftime('%Y-%m-%d %H:%M:%S')
-                    }
-            
-            return result
+        snapshot = []
+        current_time = time.time()
+        
+        # Se recorre shard a shard: cada lock se retiene solo mientras se
+        # copian las tuplas crudas de su shard
+        for shard in self.shards:
+            with shard.lock:
+                snapshot.extend(
+                    (ip, session.username, session.login_time, session.last_activity)
+                    for ip, session in shard.sessions.items()
+                    if current_time - session.last_activity <= self.session_timeout
+                )
+        
+        # El formateo de fechas (strftime) se hace sin ningún lock
+        return {
+            ip: {
+                'username': username,
+                'login_time': _format_timestamp(login_time),
+                'last_activity': _format_timestamp(last_activity)
+            }
+            for ip, username, login_time, last_activity in snapshot
+        }
+    
+    def get_active_clients(self):
+        """
+        Obtiene los clientes de las sesiones no expiradas.
+        
+        Returns:
+            Diccionario {ip: (mac o None, username)}
+        """
+        clients = {}
+        current_time = time.time()
+        for shard in self.shards:
+            with shard.lock:
+                clients.update(
+                    (ip, (session.mac, session.username))
+                    for ip, session in shard.sessions.items()
+                    if current_time - session.last_activity <= self.session_timeout
+                )
+        return clients
+    
+    def get_all_ips(self):
+        """
+        Obtiene las IPs de todas las sesiones almacenadas (incluidas las aún no purgadas).
+        
+        Returns:
+            Lista de direcciones IP
+        """
+        ips = []
+        for shard in self.shards:
+            with shard.lock:
+                ips.extend(shard.sessions)
+        return ips
     
     def cleanup_expired_sessions(self):
          
-        with self.lock:
-            current_time = time.time()
-            expired_ips = []
-            
-            for ip, session in list(self.sessions.items()):
-                if current_time - session['last_activity'] > self.session_timeout:
-                    expired_ips.append(ip)
-                    del self.sessions[ip]
+        current_time = time.time()
+        expired_ips = []
+        
+        for shard in self.shards:
+            with shard.lock:
+                expired_ips.extend(self._cleanup_shard(shard, current_time))
+        
+        return expired_ips
+    
+    def _cleanup_shard(self, shard, current_time):
+        """
+        Purga las sesiones vencidas de un shard.
+        
+        Debe llamarse con shard.lock adquirido.
+        """
+        expired_ips = []
+        heap = shard.expiry_heap
+        
+        # Solo se visitan las entradas vencidas, no todas las sesiones
+        while heap and heap[0][0] < current_time:
+            _, seq, ip = heapq.heappop(heap)
+            session = shard.sessions.get(ip)
+            if session is None or session.expiry_seq != seq:
+                continue  # Entrada obsoleta (sesión cerrada o recreada)
             
-            return expired_ips
+            if current_time - session.last_activity > self.session_timeout:
+                expired_ips.append(ip)
+                self._remove_session(shard, ip)
+            else:
+                # Hubo actividad desde que se programó: reprogramar
+                self._schedule_expiry(shard, ip, session)
+        
+        # Compactar si el heap acumula demasiadas entradas obsoletas
+        if len(heap) > 2 * len(shard.sessions) + 64:
+            shard.expiry_heap = [entry for entry in heap
+                                 if entry[2] in shard.sessions
+                                 and shard.sessions[entry[2]].expiry_seq == entry[1]]
+            heapq.heapify(shard.expiry_heap)
+        
+        return expired_ips
+    
+    def next_expiry(self):
+        """
+        Obtiene el instante más temprano en que podría expirar una sesión.
+        
+        Es una cota inferior: la sesión puede haber tenido actividad después.
+        
+        Returns:
+            Timestamp, o None si no hay sesiones
+        """
+        earliest = None
+        for shard in self.shards:
+            with shard.lock:
+                if shard.expiry_heap and (earliest is None or shard.expiry_heap[0][0] < earliest):
+                    earliest = shard.expiry_heap[0][0]
+        return earliest
     
     def get_session_count(self):
          
-        with self.lock:
-            return len(self.sessions)
+        count = 0
+        for shard in self.shards:
+            with shard.lock:
+                count += len(shard.sessions)
+        return count
     
     def get_username_by_ip(self, ip_address):
          
-        with self.lock:
-            if ip_address in self.sessions:
-                return self.sessions[ip_address]['username']
-            return None
+        shard = self._shard(ip_address)
+        with shard.lock:
+            session = shard.sessions.get(ip_address)
+            return session.username if session is not None else None
+    
+    def _active_ips_of(self, username):
+        """Obtiene las IPs del índice de un usuario cuya sesión sigue vigente."""
+        return [ip for _, ip in self._active_devices_of(username)]
+    
+    def _active_devices_of(self, username):
+        """
+        Obtiene los dispositivos con sesión vigente de un usuario.
+        
+        Se copia el índice con index_lock y después se valida cada IP con el
+        lock de su shard, respetando el orden de locks.
+        
+        Returns:
+            Lista de tuplas (login_time, ip) ordenada de más antigua a más reciente
+        """
+        with self.index_lock:
+            ips = list(self.user_index.get(username, ()))
+        
+        current_time = time.time()
+        active = []
+        for ip in ips:
+            shard = self._shard(ip)
+            with shard.lock:
+                session = shard.sessions.get(ip)
+                if (session is not None and session.username == username
+                        and current_time - session.last_activity <= self.session_timeout):
+                    active.append((session.login_time, ip))
+        active.sort()
+        return active
     
     def is_user_already_logged_in(self, username, exclude_ip=None):
         """
@@ -115,17 +532,224 @@ class SessionManager:
         Returns:
             Tupla (está_logueado, ip_donde_está_logueado)
         """
-        with self.lock:
-            current_time = time.time()
+        # Solo se miran las IPs de este usuario (índice), no todas las sesiones
+        for ip in self._active_ips_of(username):
+            # Saltar la IP excluida (la actual del cliente)
+            if exclude_ip and ip == exclude_ip:
+                continue
+            return True, ip
+        
+        return False, None
+    
+    def get_ips_by_username(self, username):
+        """
+        Obtiene las IPs con sesión activa de un usuario.
+        
+        Args:
+            username: Nombre del usuario
             
-            for ip, session in list(self.sessions.items()):
-                # Saltar la IP excluida (la actual del cliente)
-                if exclude_ip and ip == exclude_ip:
+        Returns:
+            Lista de direcciones IP
+        """
+        return self._active_ips_of(username)
+
+    
+    # ------------------------------------------------------------------
+    # Persistencia: journal append-only + compactación en snapshot
+    # ------------------------------------------------------------------
+    
+    @staticmethod
+    def _create_record(ip_address, session):
+        """Registro de journal que crea (o reemplaza) una sesión."""
+        return {
+            'op': 'create',
+            'ip': ip_address,
+            'username': session.username,
+            'login_time': session.login_time,
+            'last_activity': session.last_activity,
+            'mac': session.mac
+        }
+    
+    def _journal_append(self, record):
+        """
+        Encola un registro para el hilo escritor del journal.
+        
+        Solo se registran altas y cierres de sesión; la actividad se persiste
+        en cada compactación. Se llama con el lock del shard adquirido, así
+        que los registros de una misma IP quedan en orden, pero aquí solo se
+        añade a una lista: la serialización, la escritura y el fsync los hace
+        el hilo escritor, sin ningún lock de shard retenido.
+        """
+        if self.journal_path is None:
+            return
+        
+        with self.journal_lock:
+            self.journal_pending.append(record)
+            if self.journal_writer is None:
+                self.journal_stopping = False
+                self.journal_writer = Thread(target=self._journal_loop, name="session-journal",
+                                             daemon=True)
+                self.journal_writer.start()
+            self.journal_ready.notify()
+    
+    def _journal_loop(self):
+        """
+        Hilo escritor del journal con commit en grupo.
+        
+        Cada vuelta escribe todos los registros encolados mientras se hacía
+        el fsync anterior y los lleva a disco con un único fsync, así el
+        coste de disco se reparte entre los logins que coinciden en el tiempo.
+        """
+        while True:
+            with self.journal_lock:
+                while not self.journal_pending and not self.journal_stopping:
+                    self.journal_ready.wait()
+                if not self.journal_pending:
+                    return
+            self._journal_flush()
+    
+    def _journal_flush(self):
+        """Escribe los registros pendientes en el journal con un solo fsync."""
+        with self.journal_file_lock:
+            with self.journal_lock:
+                records, self.journal_pending = self.journal_pending, []
+            if not records:
+                return
+            
+            data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+            try:
+                if self.journal_file is None:
+                    self.journal_file = open(self.journal_path, 'a')
+                self.journal_file.write(data)
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+            except OSError as e:
+                self.logger.error(f"Error escribiendo el journal de sesiones: {e}")
+    
+    def compact(self):
+        """
+        Compacta el journal en un snapshot con el estado actual.
+        
+        1. Se escriben los registros pendientes y se rota el journal a '.old';
+           los nuevos registros van a uno vacío.
+        2. Se lee el estado shard a shard (sin los locks del journal).
+        3. El snapshot se escribe en un temporal y se publica con os.replace.
+        4. Se borra '.old'.
+        
+        Un cambio hecho entre 1 y 2 queda en el snapshot y en el journal
+        nuevo; reaplicarlo al restaurar no altera el resultado. Si el proceso
+        muere a mitad, restore() combina snapshot, '.old' y journal.
+        
+        Returns:
+            Número de sesiones escritas en el snapshot
+        """
+        if self.journal_path is None:
+            return 0
+        
+        old_path = self.journal_path + '.old'
+        self._journal_flush()
+        with self.journal_file_lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(old_path):
+                    # Compactación anterior interrumpida: conservar ambos journals
+                    with open(old_path, 'a') as old, open(self.journal_path) as current:
+                        old.write(current.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, old_path)
+        
+        records = []
+        for shard in self.shards:
+            with shard.lock:
+                records.extend(self._create_record(ip, session)
+                               for ip, session in shard.sessions.items())
+        
+        snap_path = self.journal_path + '.snap'
+        tmp_path = snap_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snap_path)
+        
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        
+        return len(records)
+    
+    def restore(self):
+        """
+        Reconstruye las sesiones desde el snapshot y el journal.
+        
+        Se descartan las sesiones ya expiradas y las líneas incompletas
+        (escritura cortada por una caída).
+        
+        Returns:
+            Diccionario {ip: mac} con las sesiones restauradas (mac puede ser None)
+        """
+        if self.journal_path is None:
+            return {}
+        
+        state = {}  # {ip: _Session}
+        for path in (self.journal_path + '.snap', self.journal_path + '.old', self.journal_path):
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
                     continue
                 
-                # Verificar si la sesión no ha expirado
-                if current_time - session['last_activity'] <= self.session_timeout:
-                    if session['username'] == username:
-                        return True, ip
+                ip = record.get('ip')
+                if record.get('op') == 'end':
+                    state.pop(ip, None)
+                elif record.get('op') == 'create':
+                    previous = state.get(ip)
+                    session = _Session(record['username'], record['login_time'], record.get('mac'))
+                    session.last_activity = record['last_activity']
+                    # La misma sesión vista en un snapshot más reciente conserva su actividad
+                    if (previous is not None and previous.username == session.username
+                            and previous.login_time == session.login_time):
+                        session.last_activity = max(session.last_activity, previous.last_activity)
+                    state[ip] = session
+        
+        current_time = time.time()
+        restored = {}
+        for ip, session in state.items():
+            if current_time - session.last_activity > self.session_timeout:
+                continue
             
-            return False, None
\ No newline at end of file
+            shard = self._shard(ip)
+            with shard.lock:
+                if ip in shard.sessions:
+                    self._remove_session(shard, ip)
+                shard.sessions[ip] = session
+                with self.index_lock:
+                    self.user_index.setdefault(session.username, set()).add(ip)
+                self._schedule_expiry(shard, ip, session)
+            restored[ip] = session.mac
+        
+        return restored
+    
+    def close(self):
+        """Escribe lo pendiente, detiene el hilo escritor y cierra el journal."""
+        with self.journal_lock:
+            writer, self.journal_writer = self.journal_writer, None
+            self.journal_stopping = True
+            self.journal_ready.notify()
+        if writer is not None:
+            writer.join()
+        
+        self._journal_flush()
+        with self.journal_file_lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None